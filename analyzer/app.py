@@ -2,10 +2,14 @@ import connexion
 import yaml
 import logging
 import logging.config
-import json
 import os
-from pykafka import KafkaClient
+import time
+from threading import Thread
+from envelope import decode_event
+from offset_index import OffsetIndex
+from kafka_pool import KafkaPool, KafkaPoolBusy
 from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 from datetime import datetime
@@ -19,35 +23,232 @@ with open('/app/log_conf.yml', 'r') as f:
 
 logger = logging.getLogger('analyzer')
 
-def get_drone_position(index):
-
-
-    logger.info(f"Request for drone position at index {index}")
-
-    # Connect to Kafka
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
+EVENT_TYPES = ('drone_position', 'target_acquisition')
+
+index_config = app_config.get('index', {})
+INDEX_CHECKPOINT_INTERVAL = index_config.get('checkpoint_interval_ms', 1000) / 1000
+OFFSET_INDEX = OffsetIndex(index_config.get('directory', '/app/data/index'), EVENT_TYPES)
+
+range_config = app_config.get('range', {})
+RANGE_DEFAULT_COUNT = range_config.get('default_count', 100)
+RANGE_MAX_COUNT = range_config.get('max_count', 1000)
+RANGE_MAX_SCAN = range_config.get('max_scan', 10000)
+
+kafka_config = app_config.get('kafka', {})
+KAFKA_POOL = KafkaPool(
+    f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+    app_config['events']['topic'],
+    logger,
+    max_concurrency=kafka_config.get('max_concurrency', 8),
+    acquire_timeout=kafka_config.get('acquire_timeout_ms', 2000) / 1000,
+    health_check_interval=kafka_config.get('health_check_interval_s', 30)
+)
+
+INDEX_RETRY_DELAY = 5
+
+def build_index():
+    """
+    Background loop: keeps the offset index up to date, reconnecting after Kafka errors.
+    """
+    while True:
+        try:
+            index_messages()
+        except Exception as e:
+            logger.error(f"Offset indexing failed, reconnecting in {INDEX_RETRY_DELAY}s: {e}")
+            KAFKA_POOL.invalidate()
+            time.sleep(INDEX_RETRY_DELAY)
+
+def index_messages():
+    """
+    Reads every partition of the topic from where the index left off and records the
+    position of each event, checkpointing on a timer.
+    """
+    topic = KAFKA_POOL.get_topic()
     consumer = topic.get_simple_consumer(
-        reset_offset_on_start=True,
-        consumer_timeout_ms=1000
+        auto_offset_reset=OffsetType.EARLIEST,
+        reset_offset_on_start=False,
+        consumer_timeout_ms=int(INDEX_CHECKPOINT_INTERVAL * 1000)
     )
 
+    try:
+        # Resume after the last indexed offset of every partition the index already knows
+        resume = [(consumer.partitions[partition_id], offset)
+                  for partition_id, offset in OFFSET_INDEX.partition_offsets.items() if partition_id in consumer.partitions]
+        if resume:
+            consumer.reset_offsets(resume)
+
+        logger.info(f"Indexing events after offsets {OFFSET_INDEX.partition_offsets}")
+
+        changed = False
+        last_checkpoint = time.monotonic()
+
+        while True:
+            msg = consumer.consume(block=True)
+
+            if msg is not None:
+                try:
+                    event_type = decode_event(msg.value).get('type')
+                except Exception as e:
+                    logger.error(f"Error decoding message at partition {msg.partition_id} offset {msg.offset}: {e}")
+                    event_type = None
+                OFFSET_INDEX.add(event_type, msg.partition_id, msg.offset)
+                changed = True
+
+            if changed and time.monotonic() - last_checkpoint >= INDEX_CHECKPOINT_INTERVAL:
+                try:
+                    OFFSET_INDEX.checkpoint()
+                    changed = False
+                except Exception as e:
+                    logger.error(f"Error checkpointing the offset index, will retry: {e}")
+                last_checkpoint = time.monotonic()
+    finally:
+        consumer.stop()
+
+def fetch_locations(locations):
+    """
+    Fetches the messages at a list of (partition, offset) locations. Each partition is
+    read in one sequential pass from its lowest wanted offset to its highest.
+    Returns {(partition, offset): envelope}; messages no longer on the topic are missing.
+    """
+    wanted = {}
+    for partition_id, offset in locations:
+        wanted.setdefault(partition_id, set()).add(offset)
+
+    found = {}
+    for partition_id, offsets in wanted.items():
+        first = min(offsets)
+        last = max(offsets)
+        with KAFKA_POOL.partition_consumer(partition_id) as consumer:
+            # A reset sets the last consumed offset, the next message is the one after it.
+            # -1 would mean LATEST, so offset 0 is reached through EARLIEST instead
+            partition = consumer.partitions[partition_id]
+            consumer.reset_offsets([(partition, first - 1 if first > 0 else OffsetType.EARLIEST)])
+
+            while True:
+                msg = consumer.consume(block=True)
+                if msg is None:
+                    break
+                if msg.offset in offsets:
+                    found[(partition_id, msg.offset)] = decode_event(msg.value)
+                if msg.offset >= last:
+                    break
+
+    return found
+
+def fetch_event(event_type, index):
+    """
+    Returns the envelope of event number index of a type with a single fetch at its
+    indexed offset, or None when it is not indexed or no longer on the topic.
+    """
+    location = OFFSET_INDEX.lookup(event_type, index)
+    if location is None:
+        return None
+
+    msg_data = fetch_locations([location]).get(location)
+    if msg_data is None:
+        logger.warning(f"Indexed {event_type} {index} at partition {location[0]} offset {location[1]} is no longer on the topic")
+
+    return msg_data
+
+def parse_timestamp(value):
+    # Payload timestamps carry a 'Z', compare everything as naive UTC
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+def get_event_range(event_type, start_index, count, drone_id, start_dt, end_dt):
+    """
+    Returns (payloads, next_index) for up to count events of a type from ordinal
+    start_index on that match the filters. Ordinals are fetched in chunks of count, so
+    an unfiltered page is one pass per partition. A filtered page stops after max_scan
+    ordinals; next_index is None once the index is exhausted. An event whose timestamp
+    cannot be read never matches a time filter.
+    """
+    count = min(count or RANGE_DEFAULT_COUNT, RANGE_MAX_COUNT)
+
+    events = []
+    index = start_index
+    scan_end = start_index + RANGE_MAX_SCAN
+
+    while len(events) < count and index < scan_end:
+        locations = OFFSET_INDEX.lookup_range(event_type, index, min(count, scan_end - index))
+        if not locations:
+            break
+
+        found = fetch_locations(locations)
+        for location in locations:
+            index += 1
+            msg_data = found.get(location)
+            if msg_data is None:
+                continue
+
+            payload = msg_data['payload']
+            if drone_id is not None and payload['drone_id'] != drone_id:
+                continue
+            if start_dt is not None or end_dt is not None:
+                try:
+                    timestamp = parse_timestamp(payload['timestamp'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if (start_dt is not None and timestamp < start_dt) or (end_dt is not None and timestamp >= end_dt):
+                    continue
+
+            events.append(payload)
+            if len(events) == count:
+                break
+
+    next_index = index if index < OFFSET_INDEX.count(event_type) else None
+    return events, next_index
+
+def range_response(event_type, start_index, count, drone_id, start_timestamp, end_timestamp):
+
+    label = event_type.replace('_', ' ')
+    logger.info(f"Request for {label} range from index {start_index}, count {count}")
+
+    try:
+        start_dt = parse_timestamp(start_timestamp) if start_timestamp else None
+        end_dt = parse_timestamp(end_timestamp) if end_timestamp else None
+    except ValueError:
+        logger.error(f"Invalid timestamp in {label} range request: {start_timestamp}, {end_timestamp}")
+        return {"message": "Invalid timestamp"}, 400
+
+    try:
+        events, next_index = get_event_range(event_type, start_index, count, drone_id, start_dt, end_dt)
+    except KafkaPoolBusy as e:
+        logger.warning(f"Rejected {label} range request: {e}")
+        return {"message": "Too many concurrent requests, try again"}, 503
+    except KafkaException as e:
+        logger.error(f"Kafka error fetching {label} range: {e}")
+        return {"message": "Kafka is unavailable, try again"}, 503
+
+    logger.info(f"Returning {len(events)} {label} events, next index {next_index}")
+
+    if next_index is None:
+        return events, 200
+    return events, 200, {"X-Next-Index": str(next_index)}
+
+def get_drone_position_range(start_index=0, count=None, drone_id=None, start_timestamp=None, end_timestamp=None):
+
+    return range_response('drone_position', start_index, count, drone_id, start_timestamp, end_timestamp)
+
+def get_target_acquisition_range(start_index=0, count=None, drone_id=None, start_timestamp=None, end_timestamp=None):
+
+    return range_response('target_acquisition', start_index, count, drone_id, start_timestamp, end_timestamp)
 
-    drone_position_index = 0
-    logger.info(f"Searching for drone position at index {index}")
+def get_drone_position(index):
 
-    for msg in consumer:
-        if msg:
-            message = msg.value.decode('utf-8')
-            msg_data = json.loads(message)
 
+    logger.info(f"Request for drone position at index {index}")
 
-            if msg_data.get('type') == 'drone_position':
-                if drone_position_index == int(index):
-                    logger.info(f"Found drone position at index {index}")
-                    return msg_data['payload'], 200
-                drone_position_index += 1
+    try:
+        msg_data = fetch_event('drone_position', int(index))
+    except KafkaPoolBusy as e:
+        logger.warning(f"Rejected drone position request: {e}")
+        return {"message": "Too many concurrent requests, try again"}, 503
+    except KafkaException as e:
+        logger.error(f"Kafka error fetching event {index}: {e}")
+        return {"message": "Kafka is unavailable, try again"}, 503
+    if msg_data is not None:
+        logger.info(f"Found drone position at index {index}")
+        return msg_data['payload'], 200
 
     logger.error(f"No drone position message found at index {index}")
     return {"message": f"No drone position message found at index {index}"}, 404
@@ -57,30 +258,17 @@ def get_target_acquisition(index):
 
     logger.info(f"Request for target acquisition at index {index}")
 
-
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    consumer = topic.get_simple_consumer(
-        reset_offset_on_start=True,
-        consumer_timeout_ms=1000
-    )
-
-
-    target_acquisition_index = 0
-    logger.info(f"Searching for target acquisition at index {index}")
-
-    for msg in consumer:
-        if msg:
-            message = msg.value.decode('utf-8')
-            msg_data = json.loads(message)
-
-
-            if msg_data.get('type') == 'target_acquisition':
-                if target_acquisition_index == int(index):
-                    logger.info(f"Found target acquisition at index {index}")
-                    return msg_data['payload'], 200
-                target_acquisition_index += 1
+    try:
+        msg_data = fetch_event('target_acquisition', int(index))
+    except KafkaPoolBusy as e:
+        logger.warning(f"Rejected target acquisition request: {e}")
+        return {"message": "Too many concurrent requests, try again"}, 503
+    except KafkaException as e:
+        logger.error(f"Kafka error fetching event {index}: {e}")
+        return {"message": "Kafka is unavailable, try again"}, 503
+    if msg_data is not None:
+        logger.info(f"Found target acquisition at index {index}")
+        return msg_data['payload'], 200
 
     logger.error(f"No target acquisition message found at index {index}")
     return {"message": f"No target acquisition message found at index {index}"}, 404
@@ -90,37 +278,26 @@ def get_stats():
 
     logger.info("Request for event stats")
 
-
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    consumer = topic.get_simple_consumer(
-        reset_offset_on_start=True,
-        consumer_timeout_ms=1000
-    )
-
-
-    drone_position_count = 0
-    target_acquisition_count = 0
-
-    for msg in consumer:
-        if msg:
-            message = msg.value.decode('utf-8')
-            msg_data = json.loads(message)
-
-            if msg_data.get('type') == 'drone_position':
-                drone_position_count += 1
-            elif msg_data.get('type') == 'target_acquisition':
-                target_acquisition_count += 1
+    # The indexing consumer counts every message it indexes, so the stats are a lookup
+    counts, offsets = OFFSET_INDEX.snapshot()
 
     stats = {
-        'num_drone_position': drone_position_count,
-        'num_target_acquisition': target_acquisition_count
+        'num_drone_position': counts['drone_position'],
+        'num_target_acquisition': counts['target_acquisition'],
+        'offsets': {str(partition_id): offset for partition_id, offset in offsets.items()}
     }
 
     logger.info(f"Event stats: {stats}")
     return stats, 200
 
+def setup_index_thread():
+
+    logger.info("Setting up offset index thread")
+    t1 = Thread(target=build_index)
+    t1.daemon = True
+    t1.start()
+    logger.info("Offset index thread setup complete")
+
 def health():
 
     return {"status": "running"}, 200
@@ -141,4 +318,5 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
 
 
 if __name__ == "__main__":
+    setup_index_thread()
     app.run(port=8200, host="0.0.0.0")
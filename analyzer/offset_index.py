@@ -0,0 +1,147 @@
+import json
+import mmap
+import os
+import struct
+from threading import Lock
+
+# The analyzer's offset index maps the ordinal of an event within its type to the
+# Kafka (partition, offset) holding it:
+#
+#   <directory>/<event type>.idx   - fixed width (int32 partition, int64 offset)
+#                                    records, record N is event N of that type
+#   <directory>/checkpoint.json    - how many records of each file are valid and
+#                                    the last offset indexed per partition
+#
+# Record files are memory-mapped and grow by doubling. Records past the checkpointed
+# count are ignored on startup and overwritten, so a crash between checkpoints only
+# means those messages are indexed again.
+
+RECORD = struct.Struct('<iq')
+INITIAL_CAPACITY = 1 << 16
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+class OffsetFile:
+    """
+    Array of (partition, offset) records backed by a memory-mapped file.
+    """
+
+    def __init__(self, filename, count):
+        self.count = count
+        self.file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+
+        size = os.fstat(self.file.fileno()).st_size
+        self.capacity = max(size // RECORD.size, INITIAL_CAPACITY)
+        if size < self.capacity * RECORD.size:
+            self.file.truncate(self.capacity * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), self.capacity * RECORD.size)
+
+    def append(self, partition_id, offset):
+        if self.count == self.capacity:
+            self.grow()
+        RECORD.pack_into(self.map, self.count * RECORD.size, partition_id, offset)
+        self.count += 1
+
+    def get(self, ordinal):
+        return RECORD.unpack_from(self.map, ordinal * RECORD.size)
+
+    def grow(self):
+        self.map.flush()
+        self.map.close()
+        self.capacity *= 2
+        self.file.truncate(self.capacity * RECORD.size)
+        self.map = mmap.mmap(self.file.fileno(), self.capacity * RECORD.size)
+
+    def flush(self):
+        self.map.flush()
+
+
+class OffsetIndex:
+    """
+    Per event type offset files plus the partition offsets they cover. Safe to share
+    between the indexing thread and request handlers.
+    """
+
+    def __init__(self, directory, event_types):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.lock = Lock()
+
+        checkpoint = {}
+        checkpoint_path = os.path.join(directory, CHECKPOINT_FILE)
+        if os.path.isfile(checkpoint_path):
+            with open(checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+
+        counts = checkpoint.get('counts', {})
+        self.partition_offsets = {int(partition_id): offset for partition_id, offset in checkpoint.get('offsets', {}).items()}
+        self.files = {
+            event_type: OffsetFile(os.path.join(directory, f"{event_type}.idx"), counts.get(event_type, 0))
+            for event_type in event_types
+        }
+
+    def add(self, event_type, partition_id, offset):
+        """
+        Records the message at (partition_id, offset). Messages of other types only
+        move the partition offset forward.
+        """
+        with self.lock:
+            if event_type in self.files:
+                self.files[event_type].append(partition_id, offset)
+            self.partition_offsets[partition_id] = offset
+
+    def lookup(self, event_type, ordinal):
+        """
+        Returns the (partition, offset) of event number ordinal of a type, or None
+        when it has not been indexed.
+        """
+        with self.lock:
+            offset_file = self.files[event_type]
+            if ordinal < 0 or ordinal >= offset_file.count:
+                return None
+            return offset_file.get(ordinal)
+
+    def lookup_range(self, event_type, start, count):
+        """
+        Returns the (partition, offset) of up to count events of a type from ordinal
+        start on, stopping at the end of the index.
+        """
+        with self.lock:
+            offset_file = self.files[event_type]
+            end = min(start + count, offset_file.count)
+            return [offset_file.get(ordinal) for ordinal in range(max(start, 0), end)]
+
+    def count(self, event_type):
+
+        with self.lock:
+            return self.files[event_type].count
+
+    def snapshot(self):
+        """
+        Returns the number of events of each type and the partition offsets, read
+        together so the counts are exactly those up to the offsets.
+        """
+        with self.lock:
+            counts = {event_type: offset_file.count for event_type, offset_file in self.files.items()}
+            return counts, dict(self.partition_offsets)
+
+    def checkpoint(self):
+        """
+        Flushes the record files, then atomically replaces the checkpoint, so it never
+        counts a record that is not on disk.
+        """
+        with self.lock:
+            for offset_file in self.files.values():
+                offset_file.flush()
+            checkpoint = {
+                "counts": {event_type: offset_file.count for event_type, offset_file in self.files.items()},
+                "offsets": {str(partition_id): offset for partition_id, offset in self.partition_offsets.items()}
+            }
+
+        filename = os.path.join(self.directory, CHECKPOINT_FILE)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
@@ -0,0 +1,132 @@
+import json
+import os
+from threading import Lock
+
+# Detected anomalies are appended to NDJSON segment files:
+#
+#   <directory>/segment-<sequence>.ndjson
+#
+# One compact JSON record per line. Only the newest segment is written to; once it
+# passes max_segment_bytes a new one is started, and closed segments are never
+# rewritten.
+#
+# Messages read again after a crash, before their offsets were committed, only repeat
+# the newest records, so append skips an event already logged in the active or the
+# previous segment; only those two segments' keys are kept in memory. Readers drop
+# any repeat older than that.
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".ndjson"
+
+
+def record_key(record):
+    return record.get('type'), record.get('payload', {}).get('trace_id')
+
+
+class AnomalyLog:
+
+    def __init__(self, directory, max_segment_bytes=16 * 2 ** 20):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.lock = Lock()
+
+        sequences = self.segment_sequences()
+        self.sequence = sequences[-1] if sequences else 0
+        self.truncate_partial_line(self.segment_path(self.sequence))
+        self.previous_keys = self.segment_keys(self.sequence - 1)
+        self.keys = self.segment_keys(self.sequence)
+        self.file = open(self.segment_path(self.sequence), 'a')
+
+    def truncate_partial_line(self, path):
+        """
+        Cuts a line left incomplete by a crash off the end of the segment, so appends
+        start on a fresh line.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'r+b') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def segment_keys(self, sequence):
+
+        path = self.segment_path(sequence)
+        if not os.path.exists(path):
+            return set()
+        keys = set()
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                keys.add(record_key(json.loads(line)))
+        return keys
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{sequence:08d}{SEGMENT_SUFFIX}")
+
+    def segment_sequences(self):
+        return sorted(
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def append(self, record):
+        """
+        Appends a record. Returns False, writing nothing, when the event was logged recently.
+        """
+        key = record_key(record)
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            if key in self.keys or key in self.previous_keys:
+                return False
+            self.file.write(line)
+            self.keys.add(key)
+            if self.file.tell() >= self.max_segment_bytes:
+                self.rotate()
+        return True
+
+    def rotate(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.sequence += 1
+        self.file = open(self.segment_path(self.sequence), 'a')
+        self.previous_keys = self.keys
+        self.keys = set()
+
+    def sync(self):
+        """
+        Makes every appended record durable. Called before offsets are committed.
+        """
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def records(self, event_type=None):
+        """
+        Yields the logged records oldest first, each event once.
+        """
+        with self.lock:
+            self.file.flush()
+            files = [open(self.segment_path(sequence), 'r') for sequence in self.segment_sequences()]
+
+        seen = set()
+        try:
+            for f in files:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # A line cut short by a crash or still being written
+                        break
+                    record = json.loads(line)
+                    key = record_key(record)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if event_type is None or record.get('type') == event_type:
+                        yield record
+        finally:
+            for f in files:
+                f.close()
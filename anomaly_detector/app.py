@@ -4,11 +4,18 @@ import logging
 import logging.config
 import json
 import os
-from pykafka import KafkaClient
+import threading
+import time
+from envelope import decode_event
+from kafka_pool import KafkaPool
+from anomaly_log import AnomalyLog
+from rules import RuleEngine, load_rules
+from baselines import EwmaDetector
+from kinematics import KinematicDetector
 from pykafka.common import OffsetType
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
-from datetime import datetime
+from datetime import datetime, timezone
 
 with open('/app/config/app_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -19,77 +26,361 @@ with open('/app/log_conf.yml', 'r') as f:
 
 logger = logging.getLogger('anomaly_detector')
 
-def update_anomalies():
+kafka_config = app_config.get('kafka', {})
+KAFKA_POOL = KafkaPool(
+    f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+    app_config['events']['topic'],
+    logger,
+    max_concurrency=kafka_config.get('max_concurrency', 8),
+    acquire_timeout=kafka_config.get('acquire_timeout_ms', 2000) / 1000,
+    health_check_interval=kafka_config.get('health_check_interval_s', 30)
+)
+
+datastore_config = app_config['datastore']
+ANOMALY_LOG = AnomalyLog(
+    datastore_config.get('directory', '/app/data/anomalies'),
+    max_segment_bytes=datastore_config.get('max_segment_bytes', 16 * 2 ** 20)
+)
+
+CHECKPOINT_INTERVAL = app_config.get('detector', {}).get('checkpoint_interval_ms', 1000) / 1000
+BATCH_SIZE = app_config.get('detector', {}).get('batch_size', 500)
+SNAPSHOT_DIRECTORY = app_config.get('detector', {}).get('snapshot_directory', '/app/data/baselines')
+SNAPSHOT_INTERVAL = app_config.get('detector', {}).get('snapshot_interval_s', 60)
+DETECTOR_RETRY_DELAY = 5
+
+# Progress of the detector thread, reported by update_anomalies
+progress_lock = threading.Lock()
+progress = {
+    "num_anomalies": 0,
+    "events_processed": 0,
+    "offsets": {},
+    "last_checkpoint": None
+}
+
+
+def default_rule_configs():
     """
-    Update anomalies by reading from Kafka queue and storing anomaly data in JSON file.
-    Returns the number of anomalies detected.
+    The original two thresholds, still taken from the environment when app_conf.yml
+    has no rules.
     """
-    logger.info("Starting anomaly detection update")
+    return [
+        {
+            "name": "low_signal_strength",
+            "event_type": "drone_position",
+            "field": "signal_strength",
+            "min": int(os.environ.get("SIGNAL_STRENGHT", 60)),
+            "anomaly_type": "Low Signal Strength"
+        },
+        {
+            "name": "low_certainty",
+            "event_type": "target_acquisition",
+            "field": "certainty",
+            "min": int(os.environ.get("CERTAINTY", 70)),
+            "anomaly_type": "Low Certainty"
+        }
+    ]
 
-    # Connect to Kafka
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    consumer = topic.get_simple_consumer(
-        reset_offset_on_start=True,
-        consumer_timeout_ms=1000
+RULE_ENGINE = RuleEngine(load_rules(app_config.get('rules') or default_rule_configs()))
+logger.info(f"Loaded {len(RULE_ENGINE.rules)} anomaly rules")
+
+def find_violations(messages):
+    """
+    Evaluates a batch of envelopes. Returns {index: violations} for the anomalous ones,
+    each violation naming the rule and describing the value against its threshold.
+    """
+    try:
+        broken = RULE_ENGINE.evaluate(messages)
+    except (TypeError, ValueError) as e:
+        # A malformed value fails the whole batch, evaluate one by one to isolate it
+        logger.warning(f"Batch evaluation failed ({e}), evaluating messages one by one")
+        broken = {}
+        for i, msg_data in enumerate(messages):
+            try:
+                broken.update((i, rules) for rules in RULE_ENGINE.evaluate([msg_data]).values())
+            except (TypeError, ValueError) as e:
+                logger.error(f"Cannot evaluate message {msg_data}: {e}")
+
+    return {
+        i: [{
+            "rule": rule.name,
+            "anomaly_type": rule.anomaly_type,
+            "description": rule.describe(messages[i]['payload'][rule.field])
+        } for rule in rules]
+        for i, rules in broken.items()
+    }
+
+baseline_config = app_config.get('baselines', {})
+BASELINES = {}
+if baseline_config.get('enabled', False):
+    BASELINES = {
+        event_type: EwmaDetector(
+            fields,
+            capacity=baseline_config.get('capacity', 50000),
+            alpha=baseline_config.get('alpha', 0.05),
+            z_threshold=baseline_config.get('z_threshold', 4.0),
+            warmup=baseline_config.get('warmup', 20),
+            min_std=baseline_config.get('min_std', 1.0)
+        )
+        for event_type, fields in baseline_config.get('fields', {}).items()
+    }
+
+kinematics_config = app_config.get('kinematics', {})
+KINEMATICS = None
+if kinematics_config.get('enabled', False):
+    KINEMATICS = KinematicDetector(
+        capacity=kinematics_config.get('capacity', 50000),
+        max_speed=kinematics_config.get('max_speed_mps', 120),
+        max_climb_rate=kinematics_config.get('max_climb_rate_mps', 30),
+        min_interval=kinematics_config.get('min_interval_s', 1.0)
     )
 
-    # Initialize anomaly storage
-    anomalies = []
-    anomaly_count = 0
+# Detectors that keep per-drone state, by the name of their snapshot file
+SNAPSHOTS = {f"baselines-{event_type}.npz": detector for event_type, detector in BASELINES.items()}
+if KINEMATICS is not None:
+    SNAPSHOTS["kinematics-drone_position.npz"] = KINEMATICS
+
+def load_snapshots():
+    """
+    Restores the per-drone state of the detectors from their snapshots, dropping any
+    state folded in since. A missing or unreadable snapshot leaves that detector to
+    start from scratch.
+    """
+    for name, detector in SNAPSHOTS.items():
+        filename = os.path.join(SNAPSHOT_DIRECTORY, name)
+        # Forgetting every drone resets the detector, their rows are cleared on reuse
+        detector.table.restore([], [])
+        if not os.path.exists(filename):
+            continue
+        try:
+            detector.load(filename)
+            logger.info(f"Restored {name} with {len(detector.table.slots)} drones")
+        except Exception as e:
+            logger.error(f"Cannot restore {filename}, starting empty: {e}")
+
+def save_snapshots():
 
-    # Process messages from Kafka
-    for msg in consumer:
-        if msg:
-            message = msg.value.decode('utf-8')
-            msg_data = json.loads(message)
+    os.makedirs(SNAPSHOT_DIRECTORY, exist_ok=True)
+    for name, detector in SNAPSHOTS.items():
+        detector.save(os.path.join(SNAPSHOT_DIRECTORY, name))
+    logger.debug(f"Saved detector snapshots to {SNAPSHOT_DIRECTORY}")
 
-            # Check if the event contains an anomaly based on event type
-            is_anomaly = False
+def baseline_violations(messages):
+    """
+    Scores a batch against each drone's rolling baselines and folds it into them, so
+    every message has to be passed exactly once. Returns {index: violations}.
+    """
+    by_type = {}
+    for i, msg_data in enumerate(messages):
+        if msg_data.get('type') in BASELINES:
+            by_type.setdefault(msg_data['type'], []).append(i)
 
-            if msg_data.get('type') == 'drone_position':
-                if msg_data.get('payload', {}).get('signal_strength', 100) < int(os.environ["SIGNAL_STRENGHT"]):
-                    is_anomaly = True
-            elif msg_data.get('type') == 'target_acquisition':
-                if msg_data.get('payload', {}).get('certainty', 100) < int(os.environ["CERTAINTY"]):
-                    is_anomaly = True
+    violations = {}
+    for event_type, indexes in by_type.items():
+        try:
+            deviations = BASELINES[event_type].update([messages[i].get('payload', {}) for i in indexes])
+        except (TypeError, ValueError) as e:
+            logger.error(f"Cannot update {event_type} baselines with this batch, skipping it: {e}")
+            continue
+        for message, field, value, z, mean in deviations:
+            violations.setdefault(indexes[message], []).append({
+                "rule": f"{field}_zscore",
+                "anomaly_type": f"{field.replace('_', ' ').title()} Deviation",
+                "description": f"Detected: {value}; {z:+.1f} standard deviations from drone baseline {mean:.1f}"
+            })
+    return violations
 
-            if is_anomaly:
-                # Mark the event as an anomaly
-                msg_data['anomaly'] = True
-                anomalies.append(msg_data)
-                anomaly_count += 1
+def describe_kinematics(kind, details):
 
-    # Write anomalies to JSON datastore
-    with open(app_config['datastore']['filename'], 'w') as f:
-        json.dump(anomalies, f, indent=4)
+    if kind == 'speed':
+        return {
+            "rule": "max_speed",
+            "anomaly_type": "Impossible Velocity",
+            "description": f"Detected: {details['speed']:.1f} m/s, {details['distance']:.0f} m in {details['interval']:.1f}s (limit {KINEMATICS.max_speed} m/s)"
+        }
+    if kind == 'climb_rate':
+        return {
+            "rule": "max_climb_rate",
+            "anomaly_type": "Impossible Climb Rate",
+            "description": f"Detected: {details['climb_rate']:.1f} m/s, {details['climb']:.0f} m in {details['interval']:.1f}s (limit {KINEMATICS.max_climb_rate} m/s)"
+        }
+    last_fix = datetime.fromtimestamp(details['last_fix'], timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return {
+        "rule": "out_of_order_timestamp",
+        "anomaly_type": "Out Of Order Timestamp",
+        "description": f"Detected: {details['behind']:.1f}s before the drone's last fix at {last_fix}"
+    }
 
-    logger.info(f"Anomaly detection complete. Found {anomaly_count} anomalies.")
+def kinematic_violations(messages):
+    """
+    Checks the drone positions of a batch against each drone's last fix and records
+    them as the new last fixes, so every message has to be passed exactly once.
+    Returns {index: violations}.
+    """
+    indexes = [i for i, msg_data in enumerate(messages) if msg_data.get('type') == 'drone_position']
+    if KINEMATICS is None or not indexes:
+        return {}
 
-    # Return count of anomalies detected
-    return {"num_anomalies": anomaly_count}, 200
+    try:
+        found = KINEMATICS.update([messages[i].get('payload', {}) for i in indexes])
+    except (TypeError, ValueError) as e:
+        logger.error(f"Cannot check drone position kinematics of this batch, skipping it: {e}")
+        return {}
 
-def get_anomalies(event_type=None):
-    logger.info(f"Request to get anomalies with event_type filter: {event_type}")
+    violations = {}
+    for message, kind, details in found:
+        violations.setdefault(indexes[message], []).append(describe_kinematics(kind, details))
+    return violations
+
+def log_anomalies(messages):
+
+    violations = find_violations(messages)
+    for found in (baseline_violations(messages), kinematic_violations(messages)):
+        for i, extra in found.items():
+            violations.setdefault(i, []).extend(extra)
+
+    logged = 0
+    for i, msg_data in enumerate(messages):
+        if i in violations:
+            # Mark the event as an anomaly
+            msg_data['anomaly'] = True
+            msg_data['violations'] = violations[i]
+            # A message replayed after a crash is not logged or counted twice
+            if ANOMALY_LOG.append(msg_data):
+                logged += 1
+
+    with progress_lock:
+        progress['events_processed'] += len(messages)
+        progress['num_anomalies'] += logged
+
+def detect_anomalies():
+    """
+    Detector thread: evaluates new events as they arrive, reconnecting after Kafka errors.
+    """
+    while True:
+        try:
+            consume_events()
+        except Exception as e:
+            logger.error(f"Anomaly detection failed, reconnecting in {DETECTOR_RETRY_DELAY}s: {e}")
+            KAFKA_POOL.invalidate()
+            time.sleep(DETECTOR_RETRY_DELAY)
+
+def consume_events():
+    """
+    Reads the partitions assigned to this replica from the group's committed offsets,
+    appends anomalies to the log and checkpoints every checkpoint_interval_ms, or with
+    every snapshot_interval_s snapshot while detectors keep per-drone state.
+    """
+    # The detectors resume from the state their snapshots hold, which covers exactly
+    # the committed offsets, so after a restart every event is folded in once
+    load_snapshots()
 
-    if not os.path.exists(app_config['datastore']['filename']):
-        logger.error("Anomaly datastore file not found")
-        return {"message": "Anomaly datastore not found"}, 404
+    topic = KAFKA_POOL.get_topic()
+    # Replicas share the group, so each one evaluates only the partitions assigned to it
+    consumer = topic.get_balanced_consumer(
+        consumer_group=str.encode(app_config['events'].get('consumer_group', 'anomaly_group')),
+        managed=True,
+        auto_commit_enable=False,
+        auto_offset_reset=OffsetType.EARLIEST,
+        reset_offset_on_start=False,
+        consumer_timeout_ms=int(CHECKPOINT_INTERVAL * 1000)
+    )
+    logger.info("Balanced Kafka consumer created")
+
+    batch = []
+    pending_offsets = {}
+    last_checkpoint = time.monotonic()
+    last_snapshot = last_checkpoint
 
     try:
-        with open(app_config['datastore']['filename'], 'r') as f:
-            anomalies = json.load(f)
+        while True:
+            msg = consumer.consume(block=True)
+
+            if msg is not None:
+                try:
+                    batch.append(decode_event(msg.value))
+                except Exception as e:
+                    logger.error(f"Error decoding message at partition {msg.partition_id} offset {msg.offset}: {e}")
+                pending_offsets[msg.partition_id] = msg.offset
+
+            # Evaluate when the batch is full, the topic is idle or a checkpoint is due
+            checkpoint_due = time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL
+            if batch and (len(batch) >= BATCH_SIZE or msg is None or checkpoint_due):
+                log_anomalies(batch)
+                batch = []
+
+            if checkpoint_due:
+                # Offsets are only committed once the detector state including them is on
+                # disk. Snapshots are too large to write every second, so with stateful
+                # detectors a restart replays up to snapshot_interval_s of events
+                snapshot_due = SNAPSHOTS and time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL
+                if pending_offsets and (not SNAPSHOTS or snapshot_due):
+                    saved = True
+                    if SNAPSHOTS:
+                        try:
+                            save_snapshots()
+                            last_snapshot = time.monotonic()
+                        except Exception as e:
+                            logger.error(f"Error saving detector snapshots, offsets stay uncommitted: {e}")
+                            saved = False
+                    if saved:
+                        checkpoint(consumer, pending_offsets)
+                        pending_offsets = {}
+                last_checkpoint = time.monotonic()
+    finally:
+        consumer.stop()
+
+def checkpoint(consumer, pending_offsets):
+    """
+    Syncs the anomaly log, then commits the offsets it covers. Messages after the last
+    commit are evaluated again after a crash; the log drops the repeated anomalies.
+    """
+    ANOMALY_LOG.sync()
+
+    held = consumer.partitions
+    partition_offsets = [(held[partition_id], offset) for partition_id, offset in pending_offsets.items() if partition_id in held]
+    if partition_offsets:
+        consumer.commit_offsets(partition_offsets=partition_offsets)
+        logger.debug(f"Committed offsets {dict((p.id, o) for p, o in partition_offsets)}")
+
+    with progress_lock:
+        for partition, offset in partition_offsets:
+            progress['offsets'][str(partition.id)] = offset
+        progress['last_checkpoint'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def update_anomalies():
+    """
+    Reports the progress of the detector thread: anomalies found, events evaluated
+    since startup and the offsets committed per partition.
+    """
+    with progress_lock:
+        status = dict(progress)
+        status['offsets'] = dict(progress['offsets'])
+
+    logger.info(f"Anomaly detection progress: {status['num_anomalies']} anomalies, {status['events_processed']} events evaluated")
+
+    return status, 200
+
+def setup_detector_thread():
+
+    # The log is read once here, after that the detector keeps the count
+    progress['num_anomalies'] = sum(1 for _ in ANOMALY_LOG.records())
+
+    logger.info("Setting up anomaly detector thread")
+    t1 = threading.Thread(target=detect_anomalies)
+    t1.daemon = True
+    t1.start()
+    logger.info("Anomaly detector thread setup complete")
 
+def get_anomalies(event_type=None):
+    logger.info(f"Request to get anomalies with event_type filter: {event_type}")
+
+    try:
         valid_event_types = ['drone_position', 'target_acquisition']
         if event_type and event_type not in valid_event_types:
             logger.error(f"Invalid event type provided: {event_type}")
             return {"message": f"Invalid event type. Must be one of: {', '.join(valid_event_types)}"}, 400
 
-        if event_type:
-            filtered_anomalies = [anomaly for anomaly in anomalies if anomaly.get('type') == event_type]
-        else:
-            filtered_anomalies = anomalies
+        filtered_anomalies = list(ANOMALY_LOG.records(event_type or None))
 
         if not filtered_anomalies:
             logger.info("No anomalies found matching criteria")
@@ -99,24 +390,22 @@ def get_anomalies(event_type=None):
         transformed_anomalies = []
         for anomaly in filtered_anomalies:
 
-            transformed = {
-                "drone_id": anomaly.get('payload', {}).get('drone_id', 'unknown'),
-                "event_id": anomaly.get('payload', {}).get('trace_id', 'unknown'),
-                "trace_id": anomaly.get('payload', {}).get('trace_id', 'unknown'),
-                "event_type": anomaly.get('type', 'unknown')
-            }
-            
-            # Add anomaly-specific fields based on the event type
-            if anomaly.get('type') == 'drone_position':
-                signal_strength = anomaly.get('payload', {}).get('signal_strength', 0)
-                transformed["anomaly_type"] = "Low Signal Strength"
-                transformed["description"] = f"Detected: {signal_strength}; too low (threshold 60)"
-            elif anomaly.get('type') == 'target_acquisition':
-                certainty = anomaly.get('payload', {}).get('certainty', 0)
-                transformed["anomaly_type"] = "Low Certainty"
-                transformed["description"] = f"Detected: {certainty}; too low (threshold 70)"
-            
-            transformed_anomalies.append(transformed)
+            # Anomalies logged before the rule engine carry no violations, describe them
+            # against the current rules
+            violations = anomaly.get('violations') or find_violations([anomaly]).get(0, [{
+                "anomaly_type": "Threshold",
+                "description": "Detected under an earlier rule configuration"
+            }])
+
+            for violation in violations:
+                transformed_anomalies.append({
+                    "drone_id": anomaly.get('payload', {}).get('drone_id', 'unknown'),
+                    "event_id": anomaly.get('payload', {}).get('trace_id', 'unknown'),
+                    "trace_id": anomaly.get('payload', {}).get('trace_id', 'unknown'),
+                    "event_type": anomaly.get('type', 'unknown'),
+                    "anomaly_type": violation['anomaly_type'],
+                    "description": violation['description']
+                })
 
         logger.info(f"Returning {len(transformed_anomalies)} anomalies")
         return transformed_anomalies, 200
@@ -143,4 +432,5 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     )
 
 if __name__ == "__main__":
+    setup_detector_thread()
     app.run(port=8400, host="0.0.0.0")
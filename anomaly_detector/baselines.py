@@ -0,0 +1,215 @@
+import os
+
+import numpy as np
+
+# Per-drone rolling baselines. Every drone being tracked owns a slot, a row in
+# fixed-size state arrays; the slot table hands slots out and takes back those of
+# the least recently seen drones once all are in use, so memory depends only on
+# the capacity, never on how many drones have been seen.
+
+
+class SlotTable:
+    """
+    Map of drone id to slot number in [0, capacity). Recency is kept per slot as the
+    number of the last assign call that saw it; once every slot is taken, the least
+    recently seen hundredth of them is freed at once.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.slots = {}
+        self.owners = [None] * capacity
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.clock = 0
+        self.free = list(range(capacity - 1, -1, -1))
+
+    def assign(self, drone_ids):
+        """
+        Returns (slots, fresh): the slot of every drone id, and the slots handed to a new
+        drone in this call, whose state the caller has to reset. At most half the
+        capacity can be assigned per call.
+        """
+        self.clock += 1
+        slots = list(map(self.slots.get, drone_ids))
+        fresh = []
+
+        if None in slots:
+            # Slots seen in this call must not be evicted by its own misses
+            self.last_seen[[slot for slot in slots if slot is not None]] = self.clock
+            for i, slot in enumerate(slots):
+                if slot is None:
+                    drone_id = drone_ids[i]
+                    slot = self.slots.get(drone_id)
+                    if slot is None:
+                        if not self.free:
+                            self.evict()
+                        slot = self.free.pop()
+                        self.slots[drone_id] = slot
+                        self.owners[slot] = drone_id
+                        self.last_seen[slot] = self.clock
+                        fresh.append(slot)
+                    slots[i] = slot
+
+        slots = np.array(slots, dtype=np.int64)
+        self.last_seen[slots] = self.clock
+        return slots, fresh
+
+    def evict(self):
+
+        count = max(1, self.capacity // 100)
+        oldest = np.argpartition(self.last_seen, count - 1)[:count]
+        for slot in oldest[self.last_seen[oldest] < self.clock].tolist():
+            del self.slots[self.owners[slot]]
+            self.owners[slot] = None
+            self.free.append(slot)
+
+    def drone_ids(self):
+        """
+        Drone ids from least to most recently seen.
+        """
+        return sorted(self.slots, key=lambda drone_id: self.last_seen[self.slots[drone_id]])
+
+    def restore(self, drone_ids, slots):
+        self.slots = {}
+        self.owners = [None] * self.capacity
+        self.last_seen[:] = 0
+        for order, (drone_id, slot) in enumerate(zip(drone_ids, slots), start=1):
+            self.slots[drone_id] = int(slot)
+            self.owners[int(slot)] = drone_id
+            self.last_seen[int(slot)] = order
+        self.clock = len(self.slots)
+        self.free = [slot for slot in range(self.capacity - 1, -1, -1) if self.owners[slot] is None]
+
+
+def occurrence_rounds(slots):
+    """
+    Splits a batch into rounds in which every slot appears at most once: round k holds
+    the k-th occurrence of each slot. Rounds are applied in order, so a drone seen
+    several times in a batch is updated in message order.
+    """
+    if len(slots) == 0:
+        return []
+    order = np.argsort(slots, kind='stable')
+    sorted_slots = slots[order]
+    repeated = sorted_slots[1:] == sorted_slots[:-1]
+    if not repeated.any():
+        # The common case for batches much smaller than the fleet: one round
+        return [np.arange(len(slots))]
+
+    positions = np.arange(len(slots))
+    group_start = np.maximum.accumulate(np.where(np.concatenate(([True], ~repeated)), positions, 0))
+    occurrence = np.empty(len(slots), dtype=np.int64)
+    occurrence[order] = positions - group_start
+    return [np.flatnonzero(occurrence == k) for k in range(int(occurrence.max()) + 1)]
+
+
+class EwmaDetector:
+    """
+    Exponentially weighted mean and variance per drone and field. A value more than
+    z_threshold standard deviations from its drone's mean is reported once the drone
+    has at least warmup observations of that field. The standard deviation is taken
+    to be at least min_std, so a drone that has reported the same reading every time
+    is still scored.
+    """
+
+    def __init__(self, fields, capacity=50000, alpha=0.05, z_threshold=4.0, warmup=20, min_std=1.0):
+        self.fields = list(fields)
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.warmup = warmup
+        self.min_std = min_std
+        self.table = SlotTable(capacity)
+        self.mean = np.zeros((capacity, len(self.fields)))
+        self.var = np.zeros((capacity, len(self.fields)))
+        self.count = np.zeros((capacity, len(self.fields)), dtype=np.int64)
+
+    def update(self, payloads):
+        """
+        Scores every payload against its drone's baseline, then folds it in. Returns
+        (message index, field, value, z, mean) for each value outside the threshold.
+        """
+        # Keep batches well under the capacity, so a slot is never evicted and reused
+        # within the batch that is updating it
+        step = max(1, self.table.capacity // 2)
+        deviations = []
+        for offset in range(0, len(payloads), step):
+            for i, field, value, z, mean in self.update_chunk(payloads[offset:offset + step]):
+                deviations.append((offset + i, field, value, z, mean))
+        return deviations
+
+    def update_chunk(self, payloads):
+
+        slots, fresh = self.table.assign([payload.get('drone_id') for payload in payloads])
+        if fresh:
+            self.mean[fresh] = 0
+            self.var[fresh] = 0
+            self.count[fresh] = 0
+
+        values = np.array([[payload.get(field, np.nan) for field in self.fields] for payload in payloads], dtype=float)
+        z_scores = np.zeros_like(values)
+        baselines = np.zeros_like(values)
+
+        for indexes in occurrence_rounds(slots):
+            round_slots = slots[indexes]
+            x = values[indexes]
+            present = ~np.isnan(x)
+            mean = self.mean[round_slots]
+            var = self.var[round_slots]
+            count = self.count[round_slots]
+
+            std = np.maximum(np.sqrt(var), self.min_std)
+            scored = present & (count >= self.warmup) & (std > 0)
+            z_scores[indexes] = np.where(scored, (x - mean) / np.where(std > 0, std, 1), 0)
+            baselines[indexes] = mean
+
+            # The first value sets the mean, later ones move it by alpha
+            diff = np.where(present, x - mean, 0)
+            first = present & (count == 0)
+            increment = np.where(first, diff, self.alpha * diff)
+            self.mean[round_slots] = mean + increment
+            self.var[round_slots] = np.where(first, 0, np.where(present, (1 - self.alpha) * (var + diff * increment), var))
+            self.count[round_slots] = count + present
+
+        messages, columns = np.nonzero(np.abs(z_scores) > self.z_threshold)
+        return [
+            (i, self.fields[column], payloads[i][self.fields[column]], float(z_scores[i, column]), float(baselines[i, column]))
+            for i, column in zip(messages.tolist(), columns.tolist())
+        ]
+
+    def save(self, filename):
+        """
+        Writes the state of the tracked drones to filename, atomically.
+        """
+        drone_ids = self.table.drone_ids()
+        slots = np.array([self.table.slots[drone_id] for drone_id in drone_ids], dtype=np.int64)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as f:
+            np.savez(
+                f,
+                fields=np.array(self.fields, dtype=str),
+                drone_ids=np.array(drone_ids, dtype=str),
+                mean=self.mean[slots],
+                var=self.var[slots],
+                count=self.count[slots]
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename):
+        """
+        Restores a snapshot written by save. Fields that are no longer configured are
+        dropped, new ones start empty, and if the capacity shrank the least recently
+        seen drones are left out.
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            fields = list(data['fields'])
+            drone_ids = list(data['drone_ids'])[-self.table.capacity:]
+            kept = len(drone_ids)
+            columns = [(self.fields.index(field), column) for column, field in enumerate(fields) if field in self.fields]
+            for target, source in columns:
+                self.mean[:kept, target] = data['mean'][-kept:, source] if kept else []
+                self.var[:kept, target] = data['var'][-kept:, source] if kept else []
+                self.count[:kept, target] = data['count'][-kept:, source] if kept else []
+
+        self.table.restore(drone_ids, range(kept))
@@ -0,0 +1,102 @@
+"""
+Measures how many drone positions per second the kinematic checks handle, for the
+batched KinematicDetector and for a plain per-message loop over a dict of last
+fixes. A few percent of positions jump, climb too fast or arrive out of order, and
+some come in bursts recorded microseconds apart, which must not be flagged.
+
+    python3 bench_kinematics.py [num_drones] [num_messages]
+"""
+import math
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from kinematics import EARTH_RADIUS_M, KinematicDetector
+
+MAX_SPEED = 120.0
+MAX_CLIMB_RATE = 30.0
+MIN_INTERVAL = 1.0
+START = datetime(2025, 1, 7, 10, 0, tzinfo=timezone.utc)
+
+
+def make_messages(num_drones, num_messages):
+    """
+    Every drone reports about once a second and moves a few metres; now and then a
+    position teleports, climbs 500 m, is stamped a minute in the past or is one of a
+    burst of fixes 20 us apart.
+    """
+    drones = [
+        {'drone_id': f"drone{i}", 'latitude': random.uniform(-60, 60), 'longitude': random.uniform(-180, 180), 'altitude': random.uniform(50, 500)}
+        for i in range(num_drones)
+    ]
+    clock = {}
+    payloads = []
+    for _ in range(num_messages):
+        drone = random.choice(drones)
+        step = timedelta(microseconds=20) if random.random() < 0.05 else timedelta(seconds=1)
+        now = clock[drone['drone_id']] = clock.get(drone['drone_id'], START) + step
+        drone['latitude'] += random.uniform(-1e-4, 1e-4)
+        drone['longitude'] += random.uniform(-1e-4, 1e-4)
+        drone['altitude'] += random.uniform(-2, 2)
+        payload = dict(drone, signal_strength=80)
+
+        odd = random.random()
+        if odd < 0.01:
+            payload['latitude'] += 1
+        elif odd < 0.02:
+            payload['altitude'] += 500
+        elif odd < 0.03:
+            now -= timedelta(minutes=1)
+        payload['timestamp'] = now.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        payloads.append(payload)
+    return payloads
+
+
+def loop_evaluate(payloads):
+    last_fixes = {}
+    violations = set()
+    for i, payload in enumerate(payloads):
+        timestamp = datetime.fromisoformat(payload['timestamp']).timestamp()
+        last = last_fixes.get(payload['drone_id'])
+        if last is not None:
+            interval = timestamp - last['time']
+            if interval < 0:
+                violations.add((i, 'out_of_order'))
+                continue
+            if interval < MIN_INTERVAL:
+                continue
+            lat1, lon1, lat2, lon2 = map(math.radians, (last['latitude'], last['longitude'], payload['latitude'], payload['longitude']))
+            a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+            distance = 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1, a)))
+            climb = abs(payload['altitude'] - last['altitude'])
+            if distance / interval > MAX_SPEED:
+                violations.add((i, 'speed'))
+            if climb / interval > MAX_CLIMB_RATE:
+                violations.add((i, 'climb_rate'))
+        last_fixes[payload['drone_id']] = {'latitude': payload['latitude'], 'longitude': payload['longitude'], 'altitude': payload['altitude'], 'time': timestamp}
+    return violations
+
+
+if __name__ == "__main__":
+    num_drones = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    random.seed(42)
+
+    payloads = make_messages(num_drones, num_messages)
+    print(f"{num_drones} drones, {num_messages} positions")
+
+    start = time.perf_counter()
+    expected = loop_evaluate(payloads)
+    elapsed = time.perf_counter() - start
+    print(f"  per-message loop: {num_messages / elapsed:10.0f} msgs/s")
+
+    for batch_size in (100, 500, 5000):
+        detector = KinematicDetector(capacity=max(num_drones, 2), max_speed=MAX_SPEED, max_climb_rate=MAX_CLIMB_RATE, min_interval=MIN_INTERVAL)
+        start = time.perf_counter()
+        found = set()
+        for offset in range(0, num_messages, batch_size):
+            found.update((offset + i, kind) for i, kind, _ in detector.update(payloads[offset:offset + batch_size]))
+        elapsed = time.perf_counter() - start
+
+        print(f"  detector, batch {batch_size:>5}: {num_messages / elapsed:10.0f} msgs/s  (same anomalies: {found == expected}, {len(found)})")
@@ -0,0 +1,108 @@
+"""
+Measures how many decoded messages per second the anomaly rules evaluate, for the
+compiled RuleEngine over batches and for a plain per-message loop over the same
+rules. Half the messages are drone positions and half target acquisitions.
+
+    python3 bench_rules.py [num_rules] [num_messages]
+"""
+import random
+import sys
+import time
+
+from rules import RuleEngine, load_rules
+
+FIELDS = {
+    'drone_position': ('signal_strength', 'altitude', 'latitude', 'longitude'),
+    'target_acquisition': ('certainty', 'altitude', 'latitude', 'longitude')
+}
+RANGES = {
+    'signal_strength': (0, 100),
+    'certainty': (0, 100),
+    'altitude': (0, 1000),
+    'latitude': (-90, 90),
+    'longitude': (-180, 180)
+}
+NUM_DRONES = 1000
+
+
+def make_rules(num_rules):
+    """
+    Fleet-wide ranges near the edges of each field, so a few percent of values break
+    a rule, with every fifth rule a per-drone override of an earlier one.
+    """
+    configs = []
+    for i in range(num_rules):
+        event_type = 'drone_position' if i % 2 == 0 else 'target_acquisition'
+        if i % 5 == 4 and configs:
+            base = random.choice([config for config in configs if 'drones' not in config])
+            low, high = RANGES[base['field']]
+            configs.append(dict(base, min=low + random.uniform(0, 0.1) * (high - low), drones=[f"drone{random.randrange(NUM_DRONES)}" for _ in range(10)]))
+            continue
+        field = random.choice(FIELDS[event_type])
+        low, high = RANGES[field]
+        configs.append({
+            'name': f"rule{i}",
+            'event_type': event_type,
+            'field': field,
+            'min': low + random.uniform(0, 0.01) * (high - low),
+            'max': high - random.uniform(0, 0.01) * (high - low)
+        })
+    return load_rules(configs)
+
+
+def make_messages(num_messages):
+    messages = []
+    for i in range(num_messages):
+        event_type = 'drone_position' if i % 2 == 0 else 'target_acquisition'
+        payload = {
+            'drone_id': f"drone{random.randrange(NUM_DRONES)}",
+            'latitude': random.uniform(-90, 90),
+            'longitude': random.uniform(-180, 180),
+            'altitude': random.uniform(0, 1000)
+        }
+        payload['signal_strength' if event_type == 'drone_position' else 'certainty'] = random.randrange(100)
+        messages.append({'type': event_type, 'payload': payload})
+    return messages
+
+
+def loop_evaluate(rules_by_type, messages):
+    anomalies = {}
+    for i, msg in enumerate(messages):
+        payload = msg['payload']
+        for rule in rules_by_type.get(msg['type'], ()):
+            value = payload.get(rule.field)
+            if value is None or not rule.applies_to(payload['drone_id']):
+                continue
+            if (rule.minimum is not None and value < rule.minimum) or (rule.maximum is not None and value > rule.maximum):
+                anomalies.setdefault(i, []).append(rule)
+    return anomalies
+
+
+if __name__ == "__main__":
+    num_rules = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    num_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    random.seed(42)
+
+    engine = RuleEngine(make_rules(num_rules))
+    messages = make_messages(num_messages)
+    rules_by_type = {}
+    for rule in engine.rules:
+        rules_by_type.setdefault(rule.event_type, []).append(rule)
+
+    print(f"{num_rules} rules, {num_messages} messages")
+
+    start = time.perf_counter()
+    expected = loop_evaluate(rules_by_type, messages)
+    elapsed = time.perf_counter() - start
+    print(f"  per-message loop: {num_messages / elapsed:10.0f} msgs/s")
+
+    for batch_size in (100, 500, 5000):
+        start = time.perf_counter()
+        found = {}
+        for offset in range(0, num_messages, batch_size):
+            batch = engine.evaluate(messages[offset:offset + batch_size])
+            found.update((offset + i, rules) for i, rules in batch.items())
+        elapsed = time.perf_counter() - start
+
+        same = found.keys() == expected.keys()
+        print(f"  engine, batch {batch_size:>5}: {num_messages / elapsed:10.0f} msgs/s  (same anomalies: {same})")
@@ -0,0 +1,132 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+
+# One Kafka connection per process, shared by every request handler:
+#
+#   - the KafkaClient (broker connections and topic metadata) is created once and
+#     rebuilt only after a failed health check or a connection error
+#   - single partition consumers used for point fetches are kept idle between
+#     requests instead of being created and torn down for each one
+#   - a semaphore bounds how many requests use Kafka at the same time; callers
+#     that cannot get a slot in time get KafkaPoolBusy
+#
+# This file is shared by the analyzer and anomaly_detector services; keep the
+# copies identical (check-shared-files.sh at the repository root compares them).
+
+
+class KafkaPoolBusy(Exception):
+    """
+    Raised when no Kafka slot frees up within the acquire timeout.
+    """
+
+
+class KafkaPool:
+
+    def __init__(self, hosts, topic_name, logger, max_concurrency=8, acquire_timeout=2.0, health_check_interval=30.0):
+        self.hosts = hosts
+        self.logger = logger
+        self.topic_name = topic_name
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.client = None
+        self.generation = 0
+        self.last_health_check = 0
+        self.idle_consumers = {}
+
+    def get_topic(self):
+        """
+        Returns the topic from the shared client, connecting on first use and checking
+        the connection every health_check_interval seconds.
+        """
+        with self.lock:
+            if self.client is not None and time.monotonic() - self.last_health_check >= self.health_check_interval:
+                try:
+                    self.client.update_cluster()
+                    self.last_health_check = time.monotonic()
+                except Exception as e:
+                    self.logger.warning(f"Kafka health check failed, reconnecting: {e}")
+                    self._reset()
+
+            if self.client is None:
+                self.logger.info(f"Connecting to Kafka at {self.hosts}")
+                self.client = KafkaClient(hosts=self.hosts)
+                self.last_health_check = time.monotonic()
+
+            return self.client.topics[str.encode(self.topic_name)]
+
+    def invalidate(self):
+        """
+        Drops the client and idle consumers after a connection error, the next caller
+        reconnects.
+        """
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+
+        for consumers in self.idle_consumers.values():
+            for consumer in consumers:
+                try:
+                    consumer.stop()
+                except Exception:
+                    pass
+        self.idle_consumers = {}
+        self.client = None
+        self.generation += 1
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds one of the max_concurrency Kafka slots for the duration of the block.
+        """
+        if not self.slots.acquire(timeout=self.acquire_timeout):
+            raise KafkaPoolBusy(f"No Kafka slot free within {self.acquire_timeout}s")
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def partition_consumer(self, partition_id):
+        """
+        Lends a simple consumer for one partition, holding a slot while it is out. The
+        caller positions it with reset_offsets. A consumer whose block raised is
+        stopped and the connection invalidated instead of returning it to the pool.
+        """
+        with self.slot():
+            topic = self.get_topic()
+            with self.lock:
+                generation = self.generation
+                idle = self.idle_consumers.get(partition_id)
+                consumer = idle.pop() if idle else None
+
+            if consumer is None:
+                consumer = topic.get_simple_consumer(
+                    partitions=[topic.partitions[partition_id]],
+                    auto_offset_reset=OffsetType.EARLIEST,
+                    consumer_timeout_ms=1000,
+                    # Idle consumers keep fetching in the background, keep that small
+                    queued_max_messages=10
+                )
+
+            try:
+                yield consumer
+            except Exception:
+                consumer.stop()
+                self.invalidate()
+                raise
+
+            # Consumers of a client that was replaced meanwhile are not reused
+            with self.lock:
+                if self.generation == generation:
+                    self.idle_consumers.setdefault(partition_id, []).append(consumer)
+                    consumer = None
+            if consumer is not None:
+                consumer.stop()
@@ -0,0 +1,180 @@
+import os
+from datetime import datetime, timezone
+from operator import itemgetter
+
+import numpy as np
+
+from baselines import SlotTable, occurrence_rounds
+
+# Kinematic checks on consecutive positions of a drone. The last fix of every
+# tracked drone is one row of four float arrays (latitude, longitude, altitude,
+# time), handed out by the same LRU slot table as the baselines.
+
+EARTH_RADIUS_M = 6371008.8
+FIELDS = ('drone_id', 'latitude', 'longitude', 'altitude', 'timestamp')
+
+
+def parse_timestamps(values):
+    """
+    Seconds since the epoch for a list of ISO 8601 timestamps, NaN where a value is
+    missing or unreadable. Timestamps are read as UTC.
+    """
+    # Fast path for the receiver's format, "2025-01-07T10:00:00.000Z". numpy has no
+    # notion of offsets, anything else is parsed one by one
+    try:
+        trimmed = [value[:-1] for value in values if value[-1] == 'Z']
+        if len(trimmed) == len(values):
+            return np.array(trimmed, dtype='datetime64[us]').astype(np.int64) / 1e6
+    except (TypeError, IndexError, ValueError):
+        pass
+
+    seconds = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        try:
+            timestamp = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            continue
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        seconds[i] = timestamp.timestamp()
+    return seconds
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in metres between arrays of points in degrees.
+    """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class KinematicDetector:
+    """
+    Compares every position with the drone's last fix, timed by the event timestamps
+    (the recorded time for batch uploads). Reports a horizontal speed above max_speed (m/s), a climb or descent
+    rate above max_climb_rate (m/s) and a timestamp earlier than the last fix.
+    Neither an out-of-order position nor one less than min_interval seconds after the
+    last fix replaces it: rates over such short spans are mostly GPS noise, so a burst
+    of close fixes is measured against the last one at least min_interval back.
+    """
+
+    def __init__(self, capacity=50000, max_speed=120.0, max_climb_rate=30.0, min_interval=1.0):
+        self.max_speed = max_speed
+        self.max_climb_rate = max_climb_rate
+        self.min_interval = min_interval
+        self.table = SlotTable(capacity)
+        self.latitude = np.full(capacity, np.nan)
+        self.longitude = np.full(capacity, np.nan)
+        self.altitude = np.full(capacity, np.nan)
+        self.time = np.full(capacity, np.nan)
+
+    def update(self, payloads):
+        """
+        Checks a batch of positions and records them as the drones' last fixes.
+        Returns (message index, kind, details) for every violation, kind being
+        'speed', 'climb_rate' or 'out_of_order'.
+        """
+        # As for the baselines, a slot must not be reused within the chunk using it
+        step = max(1, self.table.capacity // 2)
+        violations = []
+        for offset in range(0, len(payloads), step):
+            for i, kind, details in self.update_chunk(payloads[offset:offset + step]):
+                violations.append((offset + i, kind, details))
+        return violations
+
+    def update_chunk(self, payloads):
+
+        try:
+            # Columns in one C-level pass; a payload missing a field takes the slow path
+            drone_ids, latitudes, longitudes, altitudes, timestamps = zip(*map(itemgetter(*FIELDS), payloads))
+        except (KeyError, ValueError):
+            drone_ids, latitudes, longitudes, altitudes, timestamps = (
+                [payload.get(field) for payload in payloads] for field in FIELDS
+            )
+
+        slots, fresh = self.table.assign(drone_ids)
+        if fresh:
+            self.latitude[fresh] = np.nan
+            self.longitude[fresh] = np.nan
+            self.altitude[fresh] = np.nan
+            self.time[fresh] = np.nan
+
+        fixes = np.array([latitudes, longitudes, altitudes], dtype=float).T
+        times = parse_timestamps(timestamps)
+
+        intervals = np.full(len(payloads), np.nan)
+        distances = np.zeros(len(payloads))
+        climbs = np.zeros(len(payloads))
+        previous = np.full(len(payloads), np.nan)
+
+        for indexes in occurrence_rounds(slots):
+            round_slots = slots[indexes]
+            latitude, longitude, altitude = fixes[indexes].T
+            time = times[indexes]
+            valid = ~(np.isnan(latitude) | np.isnan(longitude) | np.isnan(time))
+
+            last_time = self.time[round_slots]
+            previous[indexes] = last_time
+            intervals[indexes] = time - last_time
+            distances[indexes] = haversine(self.latitude[round_slots], self.longitude[round_slots], latitude, longitude)
+            climbs[indexes] = np.abs(altitude - self.altitude[round_slots])
+
+            # A drone's first fix, or one at least min_interval after the last, becomes the last fix
+            keep = valid & ~(time - last_time < self.min_interval)
+            kept_slots = round_slots[keep]
+            self.latitude[kept_slots] = latitude[keep]
+            self.longitude[kept_slots] = longitude[keep]
+            self.altitude[kept_slots] = altitude[keep]
+            self.time[kept_slots] = time[keep]
+
+        # Only spans of at least min_interval are measured
+        measured = intervals >= max(self.min_interval, 1e-6)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speeds = np.where(measured, distances / intervals, 0)
+            climb_rates = np.where(measured, climbs / intervals, 0)
+
+        violations = []
+        for i in np.flatnonzero(speeds > self.max_speed).tolist():
+            violations.append((i, 'speed', {'speed': float(speeds[i]), 'distance': float(distances[i]), 'interval': float(intervals[i])}))
+        for i in np.flatnonzero(climb_rates > self.max_climb_rate).tolist():
+            violations.append((i, 'climb_rate', {'climb_rate': float(climb_rates[i]), 'climb': float(climbs[i]), 'interval': float(intervals[i])}))
+        for i in np.flatnonzero(intervals < 0).tolist():
+            violations.append((i, 'out_of_order', {'behind': float(-intervals[i]), 'last_fix': float(previous[i])}))
+        return violations
+
+    def save(self, filename):
+        """
+        Writes the last fixes of the tracked drones to filename, atomically.
+        """
+        drone_ids = self.table.drone_ids()
+        slots = np.array([self.table.slots[drone_id] for drone_id in drone_ids], dtype=np.int64)
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as f:
+            np.savez(
+                f,
+                drone_ids=np.array(drone_ids, dtype=str),
+                latitude=self.latitude[slots],
+                longitude=self.longitude[slots],
+                altitude=self.altitude[slots],
+                time=self.time[slots]
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+    def load(self, filename):
+        """
+        Restores a snapshot written by save, keeping the most recently seen drones if
+        the capacity shrank.
+        """
+        with np.load(filename, allow_pickle=False) as data:
+            drone_ids = list(data['drone_ids'])[-self.table.capacity:]
+            kept = len(drone_ids)
+            if kept:
+                self.latitude[:kept] = data['latitude'][-kept:]
+                self.longitude[:kept] = data['longitude'][-kept:]
+                self.altitude[:kept] = data['altitude'][-kept:]
+                self.time[:kept] = data['time'][-kept:]
+
+        self.table.restore(drone_ids, range(kept))
@@ -0,0 +1,133 @@
+import numpy as np
+
+# Anomaly rules, as configured under `rules` in app_conf.yml:
+#
+#   - name: low_signal_strength      rules sharing a name form one rule
+#     event_type: drone_position
+#     field: signal_strength
+#     min: 60                        a value below min or above max is an anomaly,
+#     max: 100                       either bound may be left out
+#     drones: [drone7]               optional: only for these drones, overriding the
+#     anomaly_type: Low Signal       entry without drones of the same name for them
+#
+# A RuleEngine compiles the rules of each event type once into threshold arrays and
+# evaluates a batch of payloads as a (messages x rules) comparison.
+
+
+class Rule:
+
+    def __init__(self, name, event_type, field, minimum=None, maximum=None, drones=None, anomaly_type=None):
+        self.name = name
+        self.event_type = event_type
+        self.field = field
+        self.minimum = minimum
+        self.maximum = maximum
+        self.drones = frozenset(drones) if drones else None
+        self.anomaly_type = anomaly_type or name
+        # Drones with their own entry under this name, filled in by RuleEngine
+        self.overridden = frozenset()
+
+    def applies_to(self, drone_id):
+        if self.drones is not None:
+            return drone_id in self.drones
+        return drone_id not in self.overridden
+
+    def describe(self, value):
+        if self.minimum is not None and value < self.minimum:
+            return f"Detected: {value}; too low (threshold {self.minimum})"
+        return f"Detected: {value}; too high (threshold {self.maximum})"
+
+
+def load_rules(rule_configs):
+
+    return [
+        Rule(
+            rule_config['name'],
+            rule_config['event_type'],
+            rule_config['field'],
+            minimum=rule_config.get('min'),
+            maximum=rule_config.get('max'),
+            drones=rule_config.get('drones'),
+            anomaly_type=rule_config.get('anomaly_type')
+        )
+        for rule_config in rule_configs
+    ]
+
+
+class CompiledRules:
+    """
+    The rules of one event type as arrays: for every rule the column of its field
+    and its lower and upper bounds (-inf / inf when open).
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.fields = sorted({rule.field for rule in rules})
+        self.field_columns = np.array([self.fields.index(rule.field) for rule in rules])
+        self.minimums = np.array([-np.inf if rule.minimum is None else rule.minimum for rule in rules], dtype=float)
+        self.maximums = np.array([np.inf if rule.maximum is None else rule.maximum for rule in rules], dtype=float)
+
+        # Which rules apply to a drone: the fleet-wide ones, except where the drone is
+        # listed in a rule or overridden. Only listed drones need their own row
+        self.fleet_applies = np.array([rule.drones is None for rule in rules], dtype=bool)
+        self.drone_applies = {}
+        for column, rule in enumerate(rules):
+            for drone_id in (rule.drones or frozenset()) | rule.overridden:
+                row = self.drone_applies.setdefault(drone_id, self.fleet_applies.copy())
+                row[column] = rule.applies_to(drone_id)
+
+    def evaluate(self, payloads):
+        """
+        Returns (message index, rule) pairs for every rule a payload breaks. Missing
+        fields are NaN and never break a rule.
+        """
+        values = np.array([[payload.get(field, np.nan) for field in self.fields] for payload in payloads], dtype=float)
+        broken = (values[:, self.field_columns] < self.minimums) | (values[:, self.field_columns] > self.maximums)
+
+        if self.drone_applies:
+            listed = [i for i, payload in enumerate(payloads) if payload.get('drone_id') in self.drone_applies]
+            if listed:
+                applies = np.broadcast_to(self.fleet_applies, broken.shape).copy()
+                applies[listed] = [self.drone_applies[payloads[i]['drone_id']] for i in listed]
+                broken &= applies
+            else:
+                broken &= self.fleet_applies
+
+        messages, rules = np.nonzero(broken)
+        return [(message, self.rules[rule]) for message, rule in zip(messages.tolist(), rules.tolist())]
+
+
+class RuleEngine:
+
+    def __init__(self, rules):
+        by_name = {}
+        for rule in rules:
+            by_name.setdefault((rule.event_type, rule.name), []).append(rule)
+        for entries in by_name.values():
+            overridden = frozenset().union(*(rule.drones for rule in entries if rule.drones is not None))
+            for rule in entries:
+                if rule.drones is None:
+                    rule.overridden = overridden
+
+        self.rules = rules
+        by_type = {}
+        for rule in rules:
+            by_type.setdefault(rule.event_type, []).append(rule)
+        self.compiled = {event_type: CompiledRules(type_rules) for event_type, type_rules in by_type.items()}
+
+    def evaluate(self, messages):
+        """
+        Evaluates a batch of decoded envelopes. Returns {message index: [rules broken]}
+        for the anomalous ones.
+        """
+        by_type = {}
+        for i, msg in enumerate(messages):
+            if msg.get('type') in self.compiled:
+                by_type.setdefault(msg['type'], []).append(i)
+
+        anomalies = {}
+        for event_type, indexes in by_type.items():
+            payloads = [messages[i].get('payload', {}) for i in indexes]
+            for message, rule in self.compiled[event_type].evaluate(payloads):
+                anomalies.setdefault(indexes[message], []).append(rule)
+        return anomalies
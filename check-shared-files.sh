@@ -0,0 +1,24 @@
+#!/bin/bash
+# Every service is built from its own directory, so modules they share are copied
+# into each of them. Fails when a copy differs from the first one listed.
+cd "$(dirname "$0")"
+status=0
+
+check() {
+    first=$1
+    shift
+    for copy in "$@"; do
+        if ! cmp -s "$first" "$copy"; then
+            echo "$copy differs from $first"
+            status=1
+        fi
+    done
+}
+
+check receiver/envelope.py storage/envelope.py processing/envelope.py analyzer/envelope.py anomaly_detector/envelope.py
+check analyzer/kafka_pool.py anomaly_detector/kafka_pool.py
+
+if [ $status -eq 0 ]; then
+    echo "Shared files are identical."
+fi
+exit $status
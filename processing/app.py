@@ -1,14 +1,27 @@
 import connexion
+import copy
+import hashlib
 import yaml
 import json
 import os
 import logging
 import logging.config
+import time
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Thread, Lock
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from connexion import NoContent
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+from sketches import TDigest, HyperLogLog, TopK
+from envelope import decode_event
 
 with open('/app/config/app_conf.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
@@ -19,26 +32,172 @@ with open('/app/log_conf.yml', 'r') as f:
     logging.config.dictConfig(log_config)
 
 logger = logging.getLogger('processing')
+
+http_config = app_config.get('http', {})
+HTTP_TIMEOUT = (http_config.get('connect_timeout', 2), http_config.get('read_timeout', 10))
+
+# One keep-alive session for every call to storage, retrying idempotent GETs on
+# connection errors and gateway failures
+HTTP_SESSION = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=http_config.get('retries', 3),
+        backoff_factor=http_config.get('backoff_factor', 0.2),
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET'])
+    )
+)
+HTTP_SESSION.mount('http://', http_adapter)
+HTTP_SESSION.mount('https://', http_adapter)
+
+FETCH_POOL = ThreadPoolExecutor(max_workers=2)
+
+STATS_FSYNC = app_config['datastore'].get('fsync', False)
+
+# poll reads new events from storage on the scheduler, kafka consumes the events topic
+STATS_MODE = app_config.get('stats', {}).get('mode', 'poll')
+
+# Poll mode feeds the sketches and per-drone stats from storage's per-window summaries,
+# kafka mode from every event it consumes
+sketch_config = app_config.get('sketches', {})
+SKETCHES_ENABLED = sketch_config.get('enabled', False)
+PERCENTILES = (50, 95, 99)
+CHECKPOINT_INTERVAL = app_config.get('stats', {}).get('checkpoint_interval_ms', 1000) / 1000
+# Poll windows are on the time storage wrote each event and end this far in the past,
+# so a write still committing when the window closes is read by the next one
+INGEST_DELAY = timedelta(milliseconds=app_config.get('stats', {}).get('ingest_delay_ms', 2000))
+
+# Kept in the datastore file but never sent to clients, the per-drone stats are served
+# on their own. window_end is where the next poll window starts; last_updated only moves
+# when the figures change, so the ETag does too
+INTERNAL_KEYS = ('sketches', 'offsets', 'window_end', 'drones')
+
+# Event type -> (value key, count key, max key)
+EVENT_STATS = {
+    'drone_position': ('signal_strength', 'num_drone_positions', 'max_signal_strength'),
+    'target_acquisition': ('certainty', 'num_target_acquisitions', 'max_certainty')
+}
+
+# The current stats live in memory; the datastore file is only read at startup.
+# stats_state holds the full stats, the client view without the sketches and its ETag
+stats_lock = Lock()
+stats_state = {
+    "stats": None,
+    "public": None,
+    "etag": None
+}
+
+tick_metrics = {
+    "ticks": 0,
+    "failed_ticks": 0,
+    "skipped_ticks": 0,
+    "overruns": 0,
+    "last_duration_ms": 0,
+    "max_duration_ms": 0,
+    "total_duration_ms": 0
+}
 def get_stats():
 
     logger.info("Received request for statistics.")
 
-    stats_file = app_config['datastore']['filename']
+    with stats_lock:
+        public_stats = stats_state['public']
+        etag = stats_state['etag']
 
-    if not os.path.isfile(stats_file):
-        logger.error("Statistics file does not exist.")
+    if public_stats is None:
+        logger.error("Statistics do not exist.")
         return {"message": "Statistics do not exist"}, 404
 
-    with open(stats_file, 'r') as f:
-        stats = json.load(f)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(connexion.request.headers.get('If-None-Match'), etag):
+        logger.debug("Statistics unchanged, returning 304")
+        return NoContent, 304, headers
 
-    logger.debug(f"Statistics data: {stats}")
+    logger.debug(f"Statistics data: {public_stats}")
     logger.info("Successfully retrieved statistics.")
 
-    return stats, 200
+    return public_stats, 200, headers
 
-def create_files_if_not_exist():
-    if not os.path.isfile(app_config['datastore']['filename']):
+def get_drone_stats(drone_id=None):
+
+    with stats_lock:
+        stats = stats_state['stats']
+
+    if stats is None:
+        logger.error("Statistics do not exist.")
+        return {"message": "Statistics do not exist"}, 404
+
+    drones = stats.get('drones', {})
+    drone_ids = sorted(drones) if drone_id is None else [drone_id] if drone_id in drones else []
+    return [dict(drones[key], drone_id=key) for key in drone_ids], 200
+
+def etag_matches(if_none_match, etag):
+
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak and strong validators compare the same for a GET
+    candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+    return etag in candidates
+
+def set_stats(stats):
+    """
+    Makes stats the current statistics. The client view and its ETag are computed
+    here once, so serving a poll is a lookup.
+    """
+    # The serialised sketches and offsets are internal state, clients get the summaries
+    public_stats = {key: value for key, value in stats.items() if key not in INTERNAL_KEYS}
+    body = json.dumps(public_stats, sort_keys=True).encode('utf-8')
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+    with stats_lock:
+        stats_state['stats'] = stats
+        stats_state['public'] = public_stats
+        stats_state['etag'] = etag
+
+def save_stats(stats):
+    """
+    Writes the stats to a temporary file and renames it over the datastore, so the
+    file always holds either the previous or the new stats, never a mix.
+    """
+    filename = app_config['datastore']['filename']
+    tmp_filename = filename + ".tmp"
+
+    with open(tmp_filename, 'w') as f:
+        json.dump(stats, f)
+        if STATS_FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    if STATS_FSYNC:
+        # Persist the rename itself
+        directory = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+def load_stats():
+    """
+    Reads the datastore into memory at startup, creating it when it does not exist.
+    A file that cannot be parsed is moved aside and the stats start over.
+    """
+    filename = app_config['datastore']['filename']
+    stats = None
+
+    if os.path.isfile(filename):
+        try:
+            with open(filename, 'r') as f:
+                stats = json.load(f)
+        except ValueError as e:
+            logger.error(f"Statistics file {filename} is corrupt ({e}), moving it to {filename}.corrupt")
+            os.replace(filename, filename + ".corrupt")
+
+    if stats is None:
         stats = {
             "num_drone_positions": 0,
             "num_target_acquisitions": 0,
@@ -46,44 +205,424 @@ def create_files_if_not_exist():
             "max_certainty": 0,
             "last_updated": "2000-01-01T00:00:00.000000Z"
         }
-        with open(app_config['datastore']['filename'], 'w') as f:
-            json.dump(stats, f)
+        save_stats(stats)
+
+    set_stats(stats)
+
+def iter_events(eventstore, params):
+    """
+    Yields the events of a window from storage. The NDJSON stream keeps memory flat;
+    storage versions without it are read page by page instead.
+    """
+    if 'stream_url' in eventstore:
+        with HTTP_SESSION.get(eventstore['stream_url'], params=params, stream=True, timeout=HTTP_TIMEOUT) as response:
+            if response.status_code == 200:
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+                return
+            logger.warning(f"Streaming from {eventstore['stream_url']} failed with {response.status_code}, using pages")
+
+    yield from iter_event_pages(eventstore['url'], params)
+
+def iter_event_pages(url, params):
+
+    params = dict(params)
+    # Storage returns the window one page at a time, follow the cursor to the end
+    while True:
+        response = HTTP_SESSION.get(url, params=params, timeout=HTTP_TIMEOUT)
+        # Failing the tick keeps last_updated where it was, so the window is read again
+        response.raise_for_status()
+        yield from response.json()
+
+        next_cursor = response.headers.get('X-Next-Cursor')
+        if next_cursor is None:
+            break
+        params['after'] = next_cursor
+
+def fetch_events_summary(eventstore, params, value_key, count_key, max_key):
+    """
+    Reads a window's events and returns (count, maximum, values, drones), the value
+    counts and per-drone figures as storage's summaries endpoint has them.
+    """
+    count = 0
+    maximum = None
+    values = {}
+    drones = {}
+    for event in iter_events(eventstore, params):
+        value = event[value_key]
+        count += 1
+        if maximum is None or value > maximum:
+            maximum = value
+        values[value] = values.get(value, 0) + 1
+        drone = drones.setdefault(event['drone_id'], {count_key: 0, max_key: None})
+        drone[count_key] += 1
+        if drone[max_key] is None or value > drone[max_key]:
+            drone[max_key] = value
+    return count, maximum, [[value, value_count] for value, value_count in values.items()], drones
+
+def read_window_events(start_timestamp, end_timestamp):
+    """
+    Counts a window from its events, for storage versions without the stats or summaries
+    endpoints. Returns the window stats and summaries in the form the endpoints return.
+    """
+    params = {
+        'start_timestamp': start_timestamp,
+        'end_timestamp': end_timestamp
+    }
+    stores = (
+        ('drone_positions', 'signal_strength', 'num_drone_positions', 'max_signal_strength'),
+        ('target_acquisitions', 'certainty', 'num_target_acquisitions', 'max_certainty')
+    )
+    # Both eventstores are read at the same time, so a tick takes as long as the slower one
+    futures = [
+        (FETCH_POOL.submit(fetch_events_summary, app_config['eventstores'][store], params, value_key, count_key, max_key),
+         value_key, count_key, max_key)
+        for store, value_key, count_key, max_key in stores
+    ]
+
+    window_stats = {}
+    summaries = {}
+    drones = {}
+    for future, value_key, count_key, max_key in futures:
+        count, maximum, values, window_drones = future.result()
+        window_stats[count_key] = count
+        window_stats[max_key] = maximum
+        summaries[value_key] = values
+        for drone_id, figures in window_drones.items():
+            drones.setdefault(drone_id, new_drone_stats()).update(figures)
+    summaries['drones'] = [dict(figures, drone_id=drone_id) for drone_id, figures in drones.items()]
+
+    return window_stats, summaries
+
+def add_to_sketches(sketches, value_key, event):
+
+    sketches[value_key].add(event[value_key])
+    sketches['drones'].add(event['drone_id'])
+    sketches['busiest_drones'].add(event['drone_id'])
+
+def new_sketches():
+    """
+    Returns empty sketches. Their size depends only on the configuration, never on
+    the number of events fed to them.
+    """
+    compression = sketch_config.get('compression', 100)
+    return {
+        'signal_strength': TDigest(compression),
+        'certainty': TDigest(compression),
+        'drones': HyperLogLog(sketch_config.get('hll_precision', 12)),
+        'busiest_drones': TopK(sketch_config.get('top_k_capacity', 50))
+    }
+
+def new_drone_stats():
+
+    return {
+        'num_drone_positions': 0,
+        'max_signal_strength': None,
+        'num_target_acquisitions': 0,
+        'max_certainty': None
+    }
+
+def add_drone_stats(stats, drone_id, count_key, count, max_key, maximum, seen):
+
+    drone = stats.setdefault('drones', {}).get(drone_id)
+    if drone is None:
+        drone = stats['drones'][drone_id] = new_drone_stats()
+    drone[count_key] += count
+    if maximum is not None and (drone[max_key] is None or maximum > drone[max_key]):
+        drone[max_key] = maximum
+    drone['last_seen'] = seen
+
+def add_window_summaries(stats, sketches, summaries, seen):
+    """
+    Folds one window's value counts and per-drone figures into the sketches and the
+    per-drone stats.
+    """
+    for value_key in ('signal_strength', 'certainty'):
+        for value, count in summaries[value_key]:
+            sketches[value_key].add(value, count)
+
+    for drone in summaries['drones']:
+        drone_id = drone['drone_id']
+        sketches['drones'].add(drone_id)
+        sketches['busiest_drones'].add(drone_id, drone['num_drone_positions'] + drone['num_target_acquisitions'])
+        for value_key, count_key, max_key in EVENT_STATS.values():
+            if drone[count_key]:
+                add_drone_stats(stats, drone_id, count_key, drone[count_key], max_key, drone[max_key], seen)
+
+def load_sketches(stats):
+
+    if 'sketches' not in stats:
+        return new_sketches()
+
+    data = stats['sketches']
+    return {
+        'signal_strength': TDigest.from_dict(data['signal_strength']),
+        'certainty': TDigest.from_dict(data['certainty']),
+        'drones': HyperLogLog.from_dict(data['drones']),
+        'busiest_drones': TopK.from_dict(data['busiest_drones'])
+    }
+
+def summarise_sketches(stats, sketches):
+    """
+    Writes the sketches and the figures read from them into the stats.
+    """
+    for value_key in ('signal_strength', 'certainty'):
+        digest = sketches[value_key]
+        stats[f"{value_key}_percentiles"] = {
+            f"p{p}": None if digest.count == 0 else round(digest.quantile(p / 100), 3)
+            for p in PERCENTILES
+        }
+    stats['distinct_drones'] = sketches['drones'].count()
+    stats['busiest_drones'] = sketches['busiest_drones'].top(sketch_config.get('top_drones', 10))
+    stats['sketches'] = {key: sketch.to_dict() for key, sketch in sketches.items()}
+
+    # Per-drone stats are kept for the most recently seen max_drones drones
+    drones = stats.setdefault('drones', {})
+    excess = len(drones) - sketch_config.get('max_drones', 50000)
+    if excess > 0:
+        for drone_id in sorted(drones, key=lambda key: drones[key]['last_seen'])[:excess]:
+            del drones[drone_id]
+
+def fetch_window_summaries(start_timestamp, end_timestamp):
+    """
+    Asks storage for the window's value counts and per-drone figures. Returns None when
+    storage has no summaries endpoint, so the caller can fall back to reading the events.
+    """
+    url = app_config['eventstores'].get('stats', {}).get('summaries_url')
+    if url is None:
+        return None
+
+    response = HTTP_SESSION.get(url, params={
+        'start_timestamp': start_timestamp,
+        'end_timestamp': end_timestamp
+    }, timeout=HTTP_TIMEOUT)
+    if response.status_code == 404:
+        logger.warning(f"Storage has no summaries endpoint at {url}, reading events instead")
+        return None
+    response.raise_for_status()
+
+    return response.json()
+
+def fetch_window_stats(start_timestamp, end_timestamp):
+    """
+    Asks storage for the window's counts and maxima. Returns None when storage has no
+    stats endpoint, so the caller can fall back to reading the events.
+    """
+    url = app_config['eventstores'].get('stats', {}).get('url')
+    if url is None:
+        return None
+
+    response = HTTP_SESSION.get(url, params={
+        'start_timestamp': start_timestamp,
+        'end_timestamp': end_timestamp
+    }, timeout=HTTP_TIMEOUT)
+    if response.status_code == 404:
+        logger.warning(f"Storage has no stats endpoint at {url}, reading events instead")
+        return None
+    response.raise_for_status()
+
+    return response.json()
 
 def populate_stats():
-    with open(app_config['datastore']['filename'], 'r') as f:
-        stats = json.load(f)
+    # Work on a copy, so polls keep seeing the previous stats until this tick is saved
+    with stats_lock:
+        stats = copy.deepcopy(stats_state['stats'])
 
 
     current_timestamp = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    window_start = stats.get('window_end', stats['last_updated'])
+    window_end = max(window_start, (datetime.utcnow() - INGEST_DELAY).strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+    previous = {key: stats[key] for key in ('num_drone_positions', 'num_target_acquisitions', 'max_signal_strength', 'max_certainty')}
+
+    # The counts and the summaries are read at the same time
+    stats_future = FETCH_POOL.submit(fetch_window_stats, window_start, window_end)
+    summaries_future = FETCH_POOL.submit(fetch_window_summaries, window_start, window_end) if SKETCHES_ENABLED else None
+    window_stats = stats_future.result()
+    window_summaries = summaries_future.result() if summaries_future is not None else None
 
-    def fetch_and_update_events(url, event_type, timestamp_key, value_key):
-        response = requests.get(url, params={
-            'start_timestamp': stats['last_updated'],
-            'end_timestamp': current_timestamp
-        })
-        if response.status_code == 200:
-            events = response.json()
-            stats[event_type] += len(events)
-            for event in events:
-                stats[value_key] = max(stats[value_key], event[timestamp_key])
+    if window_stats is None or (SKETCHES_ENABLED and window_summaries is None):
+        window_stats, window_summaries = read_window_events(window_start, window_end)
 
+    for count_key, max_key in (('num_drone_positions', 'max_signal_strength'), ('num_target_acquisitions', 'max_certainty')):
+        stats[count_key] += window_stats[count_key]
+        if window_stats[max_key] is not None:
+            stats[max_key] = max(stats[max_key], window_stats[max_key])
 
-    fetch_and_update_events(app_config['eventstores']['drone_positions']['url'], 'num_drone_positions', 'signal_strength', 'max_signal_strength')
-    fetch_and_update_events(app_config['eventstores']['target_acquisitions']['url'], 'num_target_acquisitions', 'certainty', 'max_certainty')
+    stats['window_end'] = window_end
+    if all(stats[key] == value for key, value in previous.items()):
+        # Nothing new: the cursor moves in memory only, the file and ETag stay as they are.
+        # After a restart the empty window is simply read again
+        set_stats(stats)
+        return
 
+    if SKETCHES_ENABLED:
+        sketches = load_sketches(stats)
+        add_window_summaries(stats, sketches, window_summaries, window_end)
+        summarise_sketches(stats, sketches)
 
     stats['last_updated'] = current_timestamp
+    save_stats(stats)
+    set_stats(stats)
 
-    with open(app_config['datastore']['filename'], 'w') as f:
-        json.dump(stats, f)
+def apply_event(stats, sketches, msg):
+    """
+    Adds one event envelope from the topic to the running stats.
+    """
+    if msg['type'] not in EVENT_STATS:
+        return
+
+    value_key, count_key, max_key = EVENT_STATS[msg['type']]
+    payload = msg['payload']
+    stats[count_key] += 1
+    stats[max_key] = max(stats[max_key], payload[value_key])
+    if sketches is not None:
+        add_to_sketches(sketches, value_key, payload)
+        add_drone_stats(stats, payload['drone_id'], count_key, 1, max_key, payload[value_key], msg.get('datetime', ''))
+
+def checkpoint_stats(consumer, stats, sketches, offsets):
+    """
+    Saves the running stats together with the last offset they include per partition,
+    then commits those offsets. After a restart messages at or below the saved offsets
+    are skipped, so a crash between the two steps counts nothing twice.
+    """
+    stats['last_updated'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    stats['offsets'] = {str(partition_id): offset for partition_id, offset in offsets.items()}
+    if sketches is not None:
+        summarise_sketches(stats, sketches)
+
+    snapshot = copy.deepcopy(stats)
+    save_stats(snapshot)
+    set_stats(snapshot)
+
+    held = consumer.partitions
+    partition_offsets = [(held[partition_id], offset) for partition_id, offset in offsets.items() if partition_id in held]
+    if not partition_offsets:
+        return
+
+    try:
+        consumer.commit_offsets(partition_offsets=partition_offsets)
+        logger.debug(f"Committed offsets {dict((p.id, o) for p, o in partition_offsets)}")
+    except Exception as e:
+        # The saved offsets still guard against double counting, the next checkpoint retries
+        logger.error(f"Error committing offsets: {e}")
+
+def consume_events():
+    """
+    Kafka mode: keeps the stats up to date from the events topic, checkpointing them
+    every checkpoint_interval_ms while there is something new.
+    """
+    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
+    topic_name = app_config['events']['topic']
+
+    logger.info(f"Connecting to Kafka at {hostname}, topic {topic_name}")
+
+    client = KafkaClient(hosts=hostname)
+    topic = client.topics[str.encode(topic_name)]
+
+    # Processing has its own group, so it reads every event independently of storage.
+    # Stats are totals, so a new group starts from the beginning of the topic
+    consumer = topic.get_balanced_consumer(
+        consumer_group=str.encode(app_config['events'].get('consumer_group', 'processing_group')),
+        managed=True,
+        auto_commit_enable=False,
+        reset_offset_on_start=False,
+        auto_offset_reset=OffsetType.EARLIEST,
+        consumer_timeout_ms=int(CHECKPOINT_INTERVAL * 1000)
+    )
+
+    with stats_lock:
+        stats = copy.deepcopy(stats_state['stats'])
+    sketches = load_sketches(stats) if SKETCHES_ENABLED else None
+    offsets = {int(partition_id): offset for partition_id, offset in stats.get('offsets', {}).items()}
+
+    logger.info(f"Consumer created, resuming after offsets {offsets}")
+
+    changed = False
+    last_checkpoint = time.monotonic()
+
+    while True:
+        msg = consumer.consume(block=True)
+
+        if msg is not None and msg.offset > offsets.get(msg.partition_id, -1):
+            try:
+                apply_event(stats, sketches, decode_event(msg.value))
+            except Exception as e:
+                logger.error(f"Error processing message at partition {msg.partition_id} offset {msg.offset}: {e}")
+            offsets[msg.partition_id] = msg.offset
+            changed = True
+
+        if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            if changed:
+                try:
+                    checkpoint_stats(consumer, stats, sketches, offsets)
+                    changed = False
+                except Exception as e:
+                    logger.error(f"Error checkpointing statistics, will retry: {e}")
+            last_checkpoint = time.monotonic()
+
+def setup_kafka_thread():
+
+    # Stats without offsets were counted in poll mode. Kafka mode reads the topic from
+    # the start and would count all of those events a second time
+    with stats_lock:
+        stats = stats_state['stats']
+    if 'offsets' not in stats and (stats['num_drone_positions'] or stats['num_target_acquisitions']):
+        logger.error(f"Statistics in {app_config['datastore']['filename']} were counted in poll mode, "
+                     "refusing to start kafka mode on them. Move the file aside to count from the topic")
+        raise SystemExit(1)
+
+    logger.info("Setting up Kafka consumer thread")
+    t1 = Thread(target=consume_events)
+    t1.daemon = True
+    t1.start()
+    logger.info("Kafka consumer thread setup complete")
+
+def run_populate_stats():
+    """
+    Scheduler entry point: runs one tick and records how long it took.
+    """
+    start = time.monotonic()
+    try:
+        populate_stats()
+    except Exception as e:
+        logger.error(f"Error populating statistics: {e}")
+        tick_metrics['failed_ticks'] += 1
+    duration = time.monotonic() - start
+
+    tick_metrics['ticks'] += 1
+    tick_metrics['last_duration_ms'] = round(duration * 1000, 3)
+    tick_metrics['max_duration_ms'] = max(tick_metrics['max_duration_ms'], tick_metrics['last_duration_ms'])
+    tick_metrics['total_duration_ms'] = round(tick_metrics['total_duration_ms'] + duration * 1000, 3)
+
+    if duration > app_config['scheduler']['interval']:
+        tick_metrics['overruns'] += 1
+        logger.warning(f"Statistics tick took {duration:.3f}s, longer than the {app_config['scheduler']['interval']}s interval")
+    else:
+        logger.debug(f"Statistics tick took {duration:.3f}s")
+
+def record_skipped_tick(event):
+
+    tick_metrics['skipped_ticks'] += 1
+    logger.warning("Skipped a statistics tick because the previous one is still running")
+
+def get_metrics():
+
+    metrics = dict(tick_metrics)
+    metrics['avg_duration_ms'] = round(metrics['total_duration_ms'] / metrics['ticks'], 3) if metrics['ticks'] else 0
+    return metrics, 200
 
 def init_scheduler():
     scheduler = BackgroundScheduler(daemon=True)
+    # One tick at a time; a tick that overran is dropped rather than queued behind it
     scheduler.add_job(
-        populate_stats,
+        run_populate_stats,
         'interval',
-        seconds=app_config['scheduler']['interval']
+        seconds=app_config['scheduler']['interval'],
+        max_instances=1,
+        coalesce=True
     )
+    scheduler.add_listener(record_skipped_tick, EVENT_JOB_MAX_INSTANCES)
     scheduler.start()
 
 
@@ -102,6 +641,9 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     )
 
 if __name__ == "__main__":
-    create_files_if_not_exist()
-    init_scheduler()
+    load_stats()
+    if STATS_MODE == 'kafka':
+        setup_kafka_thread()
+    else:
+        init_scheduler()
     app.run(port=8100, host="0.0.0.0")
@@ -0,0 +1,112 @@
+"""
+Estimates the cost of one populate_stats tick per path: bytes transferred from
+storage and client-side wall time to turn the response into the four stats.
+Responses are generated locally, so network and database time are left out. The
+sketch path is the stream path that also feeds the percentile, distinct drone and
+busiest drone sketches.
+
+    python3 bench_stats.py [events_per_interval ...]
+"""
+import json
+import random
+import sys
+import time
+import uuid
+
+from sketches import HyperLogLog, TDigest, TopK
+
+
+def make_event(i):
+    return {
+        'id': i,
+        'drone_id': f"drone{random.randrange(1000)}",
+        'latitude': random.uniform(-90, 90),
+        'longitude': random.uniform(-180, 180),
+        'altitude': random.uniform(0, 1000),
+        'signal_strength': random.randrange(100),
+        'timestamp': "2025-01-07T10:00:00.123456Z",
+        'date_created': "2025-01-07T10:00:00.123456Z",
+        'trace_id': str(uuid.uuid4()),
+        'geohash': "9q5ctr186"
+    }
+
+
+def list_tick(num_events):
+    body = json.dumps([make_event(i) for i in range(num_events)]).encode('utf-8')
+
+    start = time.perf_counter()
+    events = json.loads(body)
+    count = len(events)
+    maximum = 0
+    for event in events:
+        maximum = max(maximum, event['signal_strength'])
+    return len(body), time.perf_counter() - start
+
+
+def stream_tick(num_events):
+    lines = (json.dumps(make_event(i)).encode('utf-8') for i in range(num_events))
+    total_bytes = 0
+    elapsed = 0
+    count = 0
+    maximum = 0
+
+    for line in lines:
+        total_bytes += len(line) + 1
+        start = time.perf_counter()
+        event = json.loads(line)
+        count += 1
+        maximum = max(maximum, event['signal_strength'])
+        elapsed += time.perf_counter() - start
+    return total_bytes, elapsed
+
+
+def sketch_tick(num_events):
+    lines = (json.dumps(make_event(i)).encode('utf-8') for i in range(num_events))
+    digest = TDigest()
+    drones = HyperLogLog()
+    busiest = TopK()
+    total_bytes = 0
+    elapsed = 0
+    count = 0
+    maximum = 0
+
+    for line in lines:
+        total_bytes += len(line) + 1
+        start = time.perf_counter()
+        event = json.loads(line)
+        count += 1
+        maximum = max(maximum, event['signal_strength'])
+        digest.add(event['signal_strength'])
+        drones.add(event['drone_id'])
+        busiest.add(event['drone_id'])
+        elapsed += time.perf_counter() - start
+
+    start = time.perf_counter()
+    json.dumps({'digest': digest.to_dict(), 'drones': drones.to_dict(), 'busiest': busiest.to_dict()})
+    elapsed += time.perf_counter() - start
+    return total_bytes, elapsed
+
+
+def aggregate_tick(num_events):
+    body = json.dumps({
+        'num_drone_positions': num_events,
+        'max_signal_strength': 99,
+        'num_target_acquisitions': 0,
+        'max_certainty': None
+    }).encode('utf-8')
+
+    start = time.perf_counter()
+    stats = json.loads(body)
+    maximum = max(0, stats['max_signal_strength'])
+    return len(body), time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 1000000]
+    random.seed(42)
+
+    for num_events in sizes:
+        print(f"{num_events} events per interval")
+        for name, tick in (("list", list_tick), ("stream", stream_tick), ("sketch", sketch_tick), ("aggregate", aggregate_tick)):
+            total_bytes, elapsed = tick(num_events)
+            print(f"  {name:>9}: {total_bytes:12d} bytes  {elapsed * 1000:10.3f} ms")
@@ -0,0 +1,177 @@
+import json
+import struct
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import msgpack
+
+# Event envelopes travel on the Kafka topic in one of two encodings:
+#
+#   json    - the original text envelope {"type", "datetime", "payload"}
+#   binary  - MAGIC and VERSION bytes, then a msgpack array of the type code,
+#             the datetime and the payload values in a fixed field order per
+#             type, so no field name is stored. msgpack keeps ints, floats and
+#             strings apart, so every value decodes exactly as it was sent,
+#             and packing and unpacking run in C
+#
+# A JSON envelope always starts with '{', so consumers look at the first byte
+# of every message and decode either format. This keeps a mixed topic readable
+# while producers are switched over. Version 1 binary envelopes, a struct
+# layout, are still decoded for the events already on the topic.
+#
+# This file is shared by the receiver, storage, processing, analyzer and
+# anomaly_detector services; keep the copies identical (check-shared-files.sh
+# at the repository root compares them).
+
+MAGIC = 0xD7
+VERSION = 2
+PREFIX = bytes((MAGIC, VERSION))
+
+DRONE_POSITION = 1
+TARGET_ACQUISITION = 2
+
+TYPE_CODES = {
+    "drone_position": DRONE_POSITION,
+    "target_acquisition": TARGET_ACQUISITION
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+PAYLOAD_FIELDS = {
+    DRONE_POSITION: ("drone_id", "latitude", "longitude", "altitude", "signal_strength", "timestamp", "trace_id"),
+    TARGET_ACQUISITION: ("drone_id", "target_id", "acquisition_type", "target_type", "latitude", "longitude",
+                         "altitude", "certainty", "timestamp", "trace_id")
+}
+
+# Version 1 layout: header struct with the timestamps as microseconds and the numbers
+# as doubles, flag bits 0-3 marking numbers that were ints and bit 4 a trace id stored
+# as 16 uuid bytes, then the strings as length-prefixed utf-8
+V1_NUMERIC_FIELDS = {
+    DRONE_POSITION: ("latitude", "longitude", "altitude", "signal_strength"),
+    TARGET_ACQUISITION: ("latitude", "longitude", "altitude", "certainty")
+}
+V1_STRING_FIELDS = {
+    DRONE_POSITION: ("drone_id",),
+    TARGET_ACQUISITION: ("drone_id", "target_id", "acquisition_type", "target_type")
+}
+V1_FLAG_TRACE_UUID = 0x10
+V1_INT_FLAGS = (0x01, 0x02, 0x04, 0x08)
+V1_HEADER = struct.Struct("<BBBBqqdddd")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=4096)
+def format_second(seconds):
+    """
+    ISO 8601 form of seconds since the epoch, without building a datetime. Cached, as
+    events on the topic arrive close to time order and many share a second.
+    """
+    days, seconds = divmod(seconds, 86400)
+    return "%s%02d:%02d:%02d" % (day_prefix(days), seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+@lru_cache(maxsize=4096)
+def day_prefix(days):
+    return (EPOCH + timedelta(days=days)).strftime("%Y-%m-%dT")
+
+
+def encode_json(msg):
+    return json.dumps(msg).encode('utf-8')
+
+
+def encode_binary(msg):
+    """
+    Packs an event envelope into the binary layout. Returns None when the event
+    does not fit it, so the caller can fall back to JSON.
+    """
+    code = TYPE_CODES.get(msg.get("type"))
+    if code is None:
+        return None
+
+    payload = msg["payload"]
+    fields = PAYLOAD_FIELDS[code]
+    if len(payload) != len(fields):
+        # Extra payload fields have no slot in the layout
+        return None
+
+    try:
+        return PREFIX + msgpack.packb([code, msg["datetime"], *[payload[field] for field in fields]])
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def encode_event(msg, encoding="json"):
+    if encoding == "binary":
+        data = encode_binary(msg)
+        if data is not None:
+            return data
+    elif encoding != "json":
+        raise ValueError(f"Unknown event encoding: {encoding}")
+    return encode_json(msg)
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def decode_binary(data):
+    if data[1] == 1:
+        return decode_binary_v1(data)
+    if data[1] != VERSION:
+        raise ValueError(f"Unsupported binary event version: {data[1]}")
+
+    values = msgpack.unpackb(memoryview(data)[2:])
+    fields = PAYLOAD_FIELDS.get(values[0])
+    if fields is None or len(values) != len(fields) + 2:
+        raise ValueError(f"Malformed binary event of type code {values[0]}")
+
+    return {
+        "type": TYPE_NAMES[values[0]],
+        "datetime": values[1],
+        "payload": dict(zip(fields, values[2:]))
+    }
+
+
+def decode_binary_v1(data):
+    magic, version, code, flags, datetime_micros, timestamp_micros, *numbers = V1_HEADER.unpack_from(data)
+    if code not in TYPE_NAMES:
+        raise ValueError(f"Unknown binary event type code: {code}")
+
+    payload = {}
+    pos = V1_HEADER.size
+
+    for field in V1_STRING_FIELDS[code]:
+        length = data[pos] | data[pos + 1] << 8
+        pos += 2
+        payload[field] = data[pos:pos + length].decode('utf-8')
+        pos += length
+
+    for field, value, bit in zip(V1_NUMERIC_FIELDS[code], numbers, V1_INT_FLAGS):
+        payload[field] = int(value) if flags & bit else value
+
+    seconds, fraction = divmod(timestamp_micros, 1000000)
+    payload["timestamp"] = "%s.%06dZ" % (format_second(seconds), fraction)
+
+    if flags & V1_FLAG_TRACE_UUID:
+        h = data[pos:pos + 16].hex()
+        payload["trace_id"] = f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+    else:
+        length = data[pos] | data[pos + 1] << 8
+        pos += 2
+        payload["trace_id"] = data[pos:pos + length].decode('utf-8')
+
+    return {
+        "type": TYPE_NAMES[code],
+        "datetime": format_second(datetime_micros // 1000000),
+        "payload": payload
+    }
+
+
+def decode_event(data):
+    """
+    Decodes a raw Kafka message value in either encoding into the
+    {"type", "datetime", "payload"} envelope.
+    """
+    if is_binary(data):
+        return decode_binary(data)
+    return json.loads(data)
@@ -0,0 +1,213 @@
+import base64
+import hashlib
+import math
+
+# Fixed-size, mergeable summaries behind the processing stats. Kafka mode adds events
+# one at a time, poll mode adds each window's value counts and per-drone counts from
+# storage. Each one serialises to a small JSON-friendly dict for the stats datastore.
+
+
+class TDigest:
+    """
+    Merging t-digest for streaming quantiles. Values are buffered and folded into at
+    most compression + 1 centroids. Centroid sizes follow the k1 scale function,
+    k(q) = compression / (2 pi) * asin(2q - 1): a centroid may span one unit of k, so
+    they are small near the tails and p95/p99 stay accurate.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        if len(self.buffer) >= self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        self.buffer.extend(zip(other.means, other.weights))
+        self.count += other.count
+        self.compress()
+
+    def compress(self):
+        if not self.buffer:
+            return
+
+        points = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+
+        means = []
+        weights = []
+        total = sum(weight for _, weight in points)
+        cumulative = 0
+
+        # Two neighbouring centroids always span more than one unit of k between them,
+        # and k runs over compression / 2 units, which bounds the number of centroids
+        mean, weight = points[0]
+        q_limit = self.q_limit(0)
+        for point_mean, point_weight in points[1:]:
+            if (cumulative + weight + point_weight) / total <= q_limit:
+                mean += (point_mean - mean) * point_weight / (weight + point_weight)
+                weight += point_weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                cumulative += weight
+                q_limit = self.q_limit(cumulative / total)
+                mean, weight = point_mean, point_weight
+
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+
+    def q_limit(self, q):
+        """
+        The largest quantile a centroid starting at quantile q may reach, one unit of k
+        further.
+        """
+        k = self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0), 1) - 1) + 1
+        if k >= self.compression / 4:
+            return 1
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def quantile(self, q):
+        self.compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+
+        target = q * self.count
+        cumulative = 0
+        for i, weight in enumerate(self.weights):
+            # Each centroid's mean sits at the middle of its weight
+            centre = cumulative + weight / 2
+            if target <= centre:
+                if i == 0:
+                    return self.means[0]
+                previous_centre = cumulative - self.weights[i - 1] / 2
+                fraction = (target - previous_centre) / (centre - previous_centre)
+                return self.means[i - 1] + fraction * (self.means[i] - self.means[i - 1])
+            cumulative += weight
+
+        return self.means[-1]
+
+    def to_dict(self):
+        self.compress()
+        return {
+            "compression": self.compression,
+            "means": [round(mean, 6) for mean in self.means],
+            "weights": self.weights
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        digest = cls(data["compression"])
+        digest.means = list(data["means"])
+        digest.weights = list(data["weights"])
+        digest.count = sum(digest.weights)
+        return digest
+
+
+class HyperLogLog:
+    """
+    Distinct counter using 2 ** precision one-byte registers (4 KiB at the default
+    precision, about 1.6% standard error).
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        h = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while most registers are still empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(bytes(self.registers)).decode('ascii')
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["precision"])
+        sketch.registers = bytearray(base64.b64decode(data["registers"]))
+        return sketch
+
+
+class TopK:
+    """
+    Space-Saving heavy hitters: tracks at most capacity items, so the busiest items are
+    found with bounded memory. A count may overestimate by at most its recorded error.
+    """
+
+    def __init__(self, capacity=50):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+            return
+
+        # Replace the smallest item, inheriting its count as the error bound
+        smallest = min(self.counts, key=self.counts.get)
+        floor = self.counts.pop(smallest)
+        del self.errors[smallest]
+        self.counts[item] = floor + count
+        self.errors[item] = floor
+
+    def merge(self, other):
+        for item, count in other.counts.items():
+            self.add(item, count)
+
+    def top(self, k=10):
+        items = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [{"drone_id": item, "count": count} for item, count in items]
+
+    def to_dict(self):
+        return {
+            "capacity": self.capacity,
+            "items": {item: [count, self.errors[item]] for item, count in self.counts.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["capacity"])
+        for item, (count, error) in data["items"].items():
+            sketch.counts[item] = count
+            sketch.errors[item] = error
+        return sketch
@@ -1,14 +1,22 @@
 import connexion
 from connexion import NoContent
 import httpx
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
 import yaml
 import logging
 import logging.config
 import json
 import os
+import atexit
+import threading
+from queue import Empty
+from jsonschema import Draft4Validator
+from jsonschema.exceptions import best_match
+import zlib
 from pykafka import KafkaClient
+from pykafka.partitioners import HashingPartitioner
+from envelope import encode_event
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -28,54 +36,117 @@ logger = logging.getLogger('receiver')
 client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
 topic = client.topics[str.encode(app_config['events']['topic'])]
 
-def log_drone_position(body):
+if len(topic.partitions) < app_config['events'].get('partitions', 1):
+    logger.warning(f"Topic {app_config['events']['topic']} has {len(topic.partitions)} partitions, "
+                   f"expected {app_config['events']['partitions']}; set KAFKA_PARTITIONS before the topic is created")
 
-    if 'trace_id' not in body:
-        body['trace_id'] = str(uuid.uuid4())
+# crc32 is stable across processes, unlike hash(), so every receiver replica
+# sends a given drone to the same partition
+partitioner = HashingPartitioner(hash_func=zlib.crc32)
 
-    trace_id = body.get('trace_id')
+producer_config = app_config.get('producer', {})
+event_encoding = app_config['events'].get('encoding', 'json')
+batch_config = app_config.get('batch', {})
 
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi.yml'), 'r') as f:
+    event_schemas = yaml.safe_load(f.read())['components']['schemas']
 
-    logger.info(f"Received event drone_position with a trace id of {trace_id}")
+_producer = None
+_producer_pid = None
+_producer_lock = threading.Lock()
 
 
-    data = {
-        "drone_id": body.get('drone_id'),
-        "latitude": body.get('latitude'),
-        "longitude": body.get('longitude'),
-        "altitude": body.get('altitude'),
-        "signal_strength": body.get('signal_strength'),
-        "timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-        "trace_id": trace_id
-    }
+def get_producer():
+    """
+    Returns the async producer shared by this worker process, creating it on first use.
+    The pid check makes sure a forked worker never reuses its parent's producer.
+    """
+    global _producer, _producer_pid
+
+    if _producer is not None and _producer_pid == os.getpid():
+        return _producer
+
+    with _producer_lock:
+        if _producer is None or _producer_pid != os.getpid():
+            _producer = topic.get_producer(
+                sync=False,
+                delivery_reports=True,
+                partitioner=partitioner,
+                linger_ms=producer_config.get('linger_ms', 10),
+                min_queued_messages=producer_config.get('batch_size', 500),
+                max_queued_messages=producer_config.get('max_queued_messages', 100000),
+                block_on_queue_full=producer_config.get('block_on_queue_full', True)
+            )
+            _producer_pid = os.getpid()
+
+            logger.info(f"Async Kafka producer created for worker {_producer_pid}")
+
+    return _producer
+
+
+def drain_delivery_reports(producer):
+    """
+    Logs the failed deliveries among the reports waiting for the calling thread.
+    pykafka queues a report on the thread that produced the message, so every
+    producing thread drains its own queue, without blocking, after each produce.
+    """
+    while True:
+        try:
+            msg, exc = producer.get_delivery_report(block=False)
+        except Empty:
+            return
 
+        if exc is not None:
+            logger.error(f"Failed to deliver message at partition key {msg.partition_key}: {exc!r}")
 
-    producer = topic.get_sync_producer()
+
+def stop_producer():
+    global _producer
+
+    producer = _producer
+    if producer is None or _producer_pid != os.getpid():
+        return
+
+    logger.info("Flushing Kafka producer before shutdown")
+    _producer = None
+    producer.stop()
+    logger.info("Kafka producer stopped")
+
+
+atexit.register(stop_producer)
+
+
+def produce_event(event_type, data):
     msg = {
-        "type": "drone_position",
+        "type": event_type,
         "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
         "payload": data
     }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
-
-    logger.info(f"Produced drone_position event to Kafka with trace id {trace_id}")
+    producer = get_producer()
+    producer.produce(encode_event(msg, event_encoding), partition_key=data['drone_id'].encode('utf-8'))
+    drain_delivery_reports(producer)
 
-
-    return NoContent, 201
-
-def log_target_acquisition(body):
+def build_drone_position(body, timestamp=None):
 
     if 'trace_id' not in body:
         body['trace_id'] = str(uuid.uuid4())
 
-    trace_id = body.get('trace_id')
-
+    return {
+        "drone_id": body.get('drone_id'),
+        "latitude": body.get('latitude'),
+        "longitude": body.get('longitude'),
+        "altitude": body.get('altitude'),
+        "signal_strength": body.get('signal_strength'),
+        "timestamp": timestamp or datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "trace_id": body['trace_id']
+    }
 
-    logger.info(f"Received event target_acquisition with a trace id of {trace_id}")
+def build_target_acquisition(body, timestamp=None):
 
+    if 'trace_id' not in body:
+        body['trace_id'] = str(uuid.uuid4())
 
-    data = {
+    return {
         "drone_id": body.get('drone_id'),
         "target_id": body.get('target_id'),
         "acquisition_type": body.get('acquisition_type'),
@@ -84,25 +155,148 @@ def log_target_acquisition(body):
         "longitude": body.get('longitude'),
         "altitude": body.get('altitude'),
         "certainty": body.get('certainty'),
-        "timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-        "trace_id": trace_id
+        "timestamp": timestamp or datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "trace_id": body['trace_id']
     }
 
-    producer = topic.get_sync_producer()
-    msg = {
-        "type": "target_acquisition",
-        "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        "payload": data
-    }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
+# Format checking as connexion does for the single-event routes, so both accept the same events
+BATCH_EVENTS = {
+    "drone_position": (
+        Draft4Validator(event_schemas['DronePositionEvent'], format_checker=Draft4Validator.FORMAT_CHECKER),
+        build_drone_position
+    ),
+    "target_acquisition": (
+        Draft4Validator(event_schemas['TargetAcquisitionEvent'], format_checker=Draft4Validator.FORMAT_CHECKER),
+        build_target_acquisition
+    )
+}
+
+def normalise_timestamp(value):
+    """
+    Returns an ISO 8601 timestamp in the form storage reads, UTC with microseconds and
+    a 'Z'. A timestamp without an offset is taken as UTC. Raises ValueError if the
+    value cannot be parsed.
+    """
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def log_drone_position(body):
+
+    data = build_drone_position(body)
+    trace_id = data['trace_id']
+
+
+    logger.info(f"Received event drone_position with a trace id of {trace_id}")
+
+
+    produce_event("drone_position", data)
+
+    logger.info(f"Queued drone_position event for Kafka with trace id {trace_id}")
+
+
+    return NoContent, 201
+
+def log_target_acquisition(body):
+
+    data = build_target_acquisition(body)
+    trace_id = data['trace_id']
+
+
+    logger.info(f"Received event target_acquisition with a trace id of {trace_id}")
+
 
+    produce_event("target_acquisition", data)
 
-    logger.info(f"Produced target_acquisition event to Kafka with trace id {trace_id}")
+
+    logger.info(f"Queued target_acquisition event for Kafka with trace id {trace_id}")
 
 
     return NoContent, 201
 
+def split_batch(body):
+    """
+    Returns the raw items of a batch body, so the batch can be counted before anything
+    is produced. A JSON array arrives already parsed, an NDJSON body arrives as raw
+    bytes and is split into its non-blank lines.
+    """
+    if isinstance(body, list):
+        return body
+
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+
+    return [line for line in (body or b'').splitlines() if line.strip()]
+
+def parse_batch_item(raw):
+    """
+    Returns (item, error) for one raw item; NDJSON lines are decoded here.
+    """
+    if not isinstance(raw, bytes):
+        return raw, None
+    try:
+        return json.loads(raw), None
+    except ValueError as e:
+        return None, f"Invalid JSON: {e}"
+
+def log_batch(event_type, body):
+    validator, build = BATCH_EVENTS[event_type]
+    max_events = batch_config.get('max_events', 10000)
+
+    # Reject an oversize batch before producing any of it, so a retry cannot duplicate events
+    raw_items = split_batch(body)
+    if len(raw_items) > max_events:
+        logger.error(f"Rejected {event_type} batch of {len(raw_items)} events, larger than {max_events}")
+        return {"message": f"Batch exceeds the limit of {max_events} events"}, 413
+
+    results = []
+    accepted = 0
+
+    for index, raw in enumerate(raw_items):
+        item, error = parse_batch_item(raw)
+        if error is None and not isinstance(item, dict):
+            error = "Event must be a JSON object"
+        if error is None:
+            validation_error = best_match(validator.iter_errors(item))
+            if validation_error is not None:
+                error = validation_error.message
+
+        if error is None:
+            # A buffered event keeps the time the drone recorded it, not the time it arrived
+            try:
+                timestamp = normalise_timestamp(item['timestamp'])
+            except (TypeError, ValueError):
+                error = f"Invalid timestamp: {item['timestamp']}"
+
+        if error is not None:
+            results.append({"index": index, "status": "rejected", "error": error})
+            continue
+
+        data = build(item, timestamp)
+        try:
+            produce_event(event_type, data)
+        except Exception as e:
+            logger.error(f"Failed to queue {event_type} event with trace id {data['trace_id']}: {e}")
+            results.append({"index": index, "status": "rejected", "trace_id": data['trace_id'], "error": str(e)})
+            continue
+
+        results.append({"index": index, "status": "accepted", "trace_id": data['trace_id']})
+        accepted += 1
+
+    rejected = len(results) - accepted
+    logger.info(f"Received {event_type} batch of {len(results)} events ({accepted} accepted, {rejected} rejected)")
+
+    return {"accepted": accepted, "rejected": rejected, "results": results}, 200
+
+def log_drone_position_batch(body):
+
+    return log_batch("drone_position", body)
+
+def log_target_acquisition_batch(body):
+
+    return log_batch("target_acquisition", body)
+
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True)
 
@@ -0,0 +1,85 @@
+"""
+Compares the JSON and binary event envelopes: bytes per event on the topic
+and the time consumers spend decoding them, for events in random time order
+and in time order as they arrive on the topic.
+
+    python3 bench_envelope.py [num_events]
+"""
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from envelope import decode_event, encode_event
+
+
+def make_events(count):
+    start = datetime(2025, 1, 7, 10, 0, 0)
+    events = []
+
+    for i in range(count):
+        now = start + timedelta(microseconds=random.randrange(10 ** 12))
+        common = {
+            "drone_id": f"drone{random.randrange(1000)}",
+            "latitude": random.uniform(-90, 90),
+            "longitude": random.uniform(-180, 180),
+            "altitude": random.choice([random.randrange(1000), random.uniform(0, 1000)]),
+        }
+
+        if i % 2 == 0:
+            payload = dict(common, signal_strength=random.randrange(100))
+            event_type = "drone_position"
+        else:
+            payload = dict(
+                common,
+                target_id=f"target{random.randrange(10000)}",
+                acquisition_type=random.choice(["visual", "thermal", "radar"]),
+                target_type=random.choice(["truck", "human", "group of humans"]),
+                certainty=random.randrange(100)
+            )
+            event_type = "target_acquisition"
+
+        payload["timestamp"] = now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        payload["trace_id"] = str(uuid.uuid4())
+
+        events.append({
+            "type": event_type,
+            "datetime": now.strftime("%Y-%m-%dT%H:%M:%S"),
+            "payload": payload
+        })
+
+    return events
+
+
+def bench(encoding, events):
+    start = time.perf_counter()
+    encoded = [encode_event(event, encoding) for event in events]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = [decode_event(data) for data in encoded]
+    decode_time = time.perf_counter() - start
+
+    assert decoded == events, f"{encoding} envelope did not round trip"
+
+    total_bytes = sum(len(data) for data in encoded)
+    count = len(events)
+    print(f"{encoding:>6}: {total_bytes / count:7.1f} bytes/event  "
+          f"encode {encode_time / count * 1e6:6.2f} us/event  "
+          f"decode {decode_time / count * 1e6:6.2f} us/event")
+
+
+if __name__ == "__main__":
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(42)
+    events = make_events(num_events)
+
+    print(f"{num_events} events, half drone_position and half target_acquisition")
+    bench("json", events)
+    bench("binary", events)
+
+    events.sort(key=lambda event: event["payload"]["timestamp"])
+    print("in time order")
+    bench("json", events)
+    bench("binary", events)
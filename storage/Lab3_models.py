@@ -1,10 +1,17 @@
-from sqlalchemy import Column, String, Float, Integer, DateTime
+from sqlalchemy import Column, String, Float, Integer, DateTime, Index
 from datetime import datetime
 from sqlalchemy.orm import declarative_base
 Base = declarative_base()
 
 class DronePositionEvent(Base):
     __tablename__ = 'drone_position_events'
+    __table_args__ = (
+        Index('ix_drone_position_events_timestamp_id', 'timestamp', 'id'),
+        Index('ix_drone_position_events_drone_id_timestamp_id', 'drone_id', 'timestamp', 'id'),
+        Index('ux_drone_position_events_trace_id', 'trace_id', unique=True),
+        Index('ix_drone_position_events_geohash_timestamp', 'geohash', 'timestamp'),
+        Index('ix_drone_position_events_date_created', 'date_created'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     drone_id = Column(String(255), nullable=False)
@@ -15,6 +22,7 @@ class DronePositionEvent(Base):
     timestamp = Column(DateTime, nullable=False)
     date_created = Column(DateTime, default=datetime.utcnow, nullable=False)
     trace_id = Column(String(255), nullable=False)
+    geohash = Column(String(12), nullable=True)
 
     def to_dict(self):
         return {
@@ -26,11 +34,19 @@ class DronePositionEvent(Base):
             'signal_strength': self.signal_strength,
             'timestamp': self.timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
             'date_created': self.date_created.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            'trace_id': self.trace_id
+            'trace_id': self.trace_id,
+            'geohash': self.geohash
         }
 
 class TargetAcquisitionEvent(Base):
     __tablename__ = 'target_acquisition_events'
+    __table_args__ = (
+        Index('ix_target_acquisition_events_timestamp_id', 'timestamp', 'id'),
+        Index('ix_target_acquisition_events_drone_id_timestamp_id', 'drone_id', 'timestamp', 'id'),
+        Index('ux_target_acquisition_events_trace_id', 'trace_id', unique=True),
+        Index('ix_target_acquisition_events_geohash_timestamp', 'geohash', 'timestamp'),
+        Index('ix_target_acquisition_events_date_created', 'date_created'),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     drone_id = Column(String(255), nullable=False)
@@ -44,6 +60,7 @@ class TargetAcquisitionEvent(Base):
     timestamp = Column(DateTime, nullable=False)
     date_created = Column(DateTime, default=datetime.utcnow, nullable=False)
     trace_id = Column(String(255), nullable=False)
+    geohash = Column(String(12), nullable=True)
 
     def to_dict(self):
         return {
@@ -58,5 +75,32 @@ class TargetAcquisitionEvent(Base):
             'certainty': self.certainty,
             'timestamp': self.timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
             'date_created': self.date_created.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            'trace_id': self.trace_id
+            'trace_id': self.trace_id,
+            'geohash': self.geohash
         }
+
+class DronePositionRollup(Base):
+    __tablename__ = 'drone_position_rollups'
+
+    bucket_start = Column(DateTime, primary_key=True)
+    drone_id = Column(String(255), primary_key=True)
+    count = Column(Integer, nullable=False)
+    min_signal_strength = Column(Float, nullable=False)
+    max_signal_strength = Column(Float, nullable=False)
+    sum_signal_strength = Column(Float, nullable=False)
+    min_altitude = Column(Float, nullable=False)
+    max_altitude = Column(Float, nullable=False)
+    sum_altitude = Column(Float, nullable=False)
+
+class TargetAcquisitionRollup(Base):
+    __tablename__ = 'target_acquisition_rollups'
+
+    bucket_start = Column(DateTime, primary_key=True)
+    drone_id = Column(String(255), primary_key=True)
+    count = Column(Integer, nullable=False)
+    min_certainty = Column(Float, nullable=False)
+    max_certainty = Column(Float, nullable=False)
+    sum_certainty = Column(Float, nullable=False)
+    min_altitude = Column(Float, nullable=False)
+    max_altitude = Column(Float, nullable=False)
+    sum_altitude = Column(Float, nullable=False)
@@ -1,18 +1,29 @@
 import connexion
-from sqlalchemy import select
+from sqlalchemy import select, delete, and_, or_, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from connexion import NoContent
+from flask import Response, stream_with_context
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from Lab3_models import Base, DronePositionEvent, TargetAcquisitionEvent
-from datetime import datetime
+from Lab3_models import Base, DronePositionEvent, TargetAcquisitionEvent, DronePositionRollup, TargetAcquisitionRollup
+from datetime import datetime, timedelta
 import yaml
 import logging
 import logging.config
 import json
 import os
+import base64
+import heapq
+import binascii
+import time
 from pykafka import KafkaClient
+from envelope import decode_event
+import archive
+import geohash
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Thread, Lock
+from queue import Queue, Empty
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -35,10 +46,81 @@ with open('/app/log_conf.yml', 'r') as f:
     logger = logging.getLogger('storage')
 
 # Database setup
-DB_ENGINE = create_engine(database_url)
+# Each pipeline worker holds a connection while it writes a batch
+DB_ENGINE = create_engine(database_url, pool_size=app_config['pipeline']['workers'] + 2)
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+NUM_WORKERS = app_config['pipeline']['workers']
+COMMIT_INTERVAL = app_config['pipeline']['commit_interval_ms'] / 1000
+
+persisted_offsets = {}
+persisted_offsets_lock = Lock()
+
+PAGE_DEFAULT_LIMIT = app_config['pagination']['default_limit']
+PAGE_MAX_LIMIT = app_config['pagination']['max_limit']
+
+STREAM_CHUNK_SIZE = app_config['pagination'].get('stream_chunk_size', 1000)
+
+ROLLUP_FIELDS = {
+    DronePositionRollup: ('signal_strength', 'altitude'),
+    TargetAcquisitionRollup: ('certainty', 'altitude')
+}
+
+# Model, value column, count key and max key of the window stats
+STATS_COLUMNS = (
+    (DronePositionEvent, DronePositionEvent.signal_strength, 'num_drone_positions', 'max_signal_strength'),
+    (TargetAcquisitionEvent, TargetAcquisitionEvent.certainty, 'num_target_acquisitions', 'max_certainty')
+)
+
+GEOHASH_MAX_CELLS = app_config['pagination'].get('geohash_max_cells', 32)
+
+ARCHIVE_ENABLED = app_config['archive']['enabled']
+ARCHIVE_DIRECTORY = app_config['archive']['directory']
+ARCHIVE_CHUNK_SIZE = app_config['archive']['chunk_size']
+
+BATCH_MAX_ROWS = app_config['batch']['max_rows']
+BATCH_MAX_DELAY = app_config['batch']['max_delay_ms'] / 1000
+BATCH_RETRY_DELAY = 1
+BATCH_MAX_RETRY_DELAY = 30
+
+class EventBatch:
+    """
+    Rows decoded from Kafka that have not been written yet. A batch is due once it holds
+    max_rows rows or its oldest row has waited max_delay_ms.
+    """
+
+    def __init__(self):
+        self.positions = []
+        self.acquisitions = []
+        self.started = None
+
+    def __len__(self):
+        return len(self.positions) + len(self.acquisitions)
+
+    def add(self, msg):
+        payload = msg["payload"]
+
+        if msg["type"] == "drone_position":
+            self.positions.append(drone_position_row(payload))
+        elif msg["type"] == "target_acquisition":
+            self.acquisitions.append(target_acquisition_row(payload))
+        else:
+            return
+
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def due(self):
+        if self.started is None:
+            return False
+        return len(self) >= BATCH_MAX_ROWS or time.monotonic() - self.started >= BATCH_MAX_DELAY
+
+    def clear(self):
+        self.positions = []
+        self.acquisitions = []
+        self.started = None
+
 def process_messages():
 
 
@@ -51,118 +133,656 @@ def process_messages():
     topic = client.topics[str.encode(topic_name)]
 
 
-    consumer = topic.get_simple_consumer(
-        consumer_group=b'event_group',
+    # Storage replicas share the group, so partitions are balanced between them.
+    # The consumer timeout wakes the loop up so persisted offsets are committed on time.
+    consumer = topic.get_balanced_consumer(
+        consumer_group=str.encode(app_config['events'].get('consumer_group', 'event_group')),
+        managed=True,
+        auto_commit_enable=False,
         reset_offset_on_start=False,
-        auto_offset_reset=OffsetType.LATEST
+        auto_offset_reset=OffsetType.LATEST,
+        consumer_timeout_ms=COMMIT_INTERVAL * 1000
     )
 
     logger.info("Consumer created and waiting for messages...")
 
+    # Every partition is routed to exactly one worker, which keeps per-drone order and
+    # means each worker's persisted offsets always cover a contiguous prefix
+    worker_queues = [Queue(maxsize=app_config['pipeline']['queue_size']) for _ in range(NUM_WORKERS)]
+    for worker_queue in worker_queues:
+        t = Thread(target=write_events, args=(worker_queue,), daemon=True)
+        t.start()
 
-    for msg in consumer:
-        try:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            logger.info(f"Message received: {msg}")
+    last_commit = time.monotonic()
+
+    while True:
+        msg = consumer.consume(block=True)
+
+        if msg is not None:
+            # A full queue blocks here, which stops fetching until the workers catch up
+            worker_queues[msg.partition_id % NUM_WORKERS].put((msg.partition_id, msg.offset, msg.value))
+
+        if time.monotonic() - last_commit >= COMMIT_INTERVAL:
+            commit_persisted_offsets(consumer)
+            last_commit = time.monotonic()
 
-            payload = msg["payload"]
+def write_events(worker_queue):
+    """
+    Worker loop: decodes messages for its partitions, groups them into batches and
+    records the last offset per partition once the batch holding it is stored.
+    """
+    batch = EventBatch()
+    batch_offsets = {}
 
-            if msg["type"] == "drone_position":
+    while True:
+        timeout = None
+        if batch.started is not None:
+            timeout = max(0, batch.started + BATCH_MAX_DELAY - time.monotonic())
 
-                logger.info(f"Processing drone position event with trace_id: {payload['trace_id']}")
-                store_drone_position(payload)
+        try:
+            partition_id, offset, value = worker_queue.get(timeout=timeout)
+        except Empty:
+            partition_id = None
+
+        if partition_id is not None:
+            batch_offsets[partition_id] = offset
+            try:
+                event = decode_event(value)
+                logger.debug(f"Message received: {event}")
+                batch.add(event)
+            except Exception as e:
+                logger.error(f"Error processing message at partition {partition_id} offset {offset}: {e}")
+
+        if batch.due():
+            store_batch(batch)
+            batch.clear()
+
+        # Offsets only move past messages whose batch is in the database
+        if batch_offsets and len(batch) == 0:
+            with persisted_offsets_lock:
+                persisted_offsets.update(batch_offsets)
+            batch_offsets = {}
+
+def commit_persisted_offsets(consumer):
+
+    with persisted_offsets_lock:
+        pending = dict(persisted_offsets)
+        persisted_offsets.clear()
+
+    if not pending:
+        return
+
+    held = consumer.partitions
+    partition_offsets = [(held[partition_id], offset) for partition_id, offset in pending.items() if partition_id in held]
+
+    # Partitions lost in a rebalance are left to their new owner
+    if not partition_offsets:
+        return
+
+    try:
+        consumer.commit_offsets(partition_offsets=partition_offsets)
+        logger.debug(f"Committed offsets {dict((p.id, o) for p, o in partition_offsets)}")
+    except Exception as e:
+        logger.error(f"Error committing offsets, will retry: {e}")
+        with persisted_offsets_lock:
+            for partition, offset in partition_offsets:
+                persisted_offsets.setdefault(partition.id, offset)
+
+def drone_position_row(payload):
+
+    return {
+        'drone_id': payload['drone_id'],
+        'latitude': payload['latitude'],
+        'longitude': payload['longitude'],
+        'altitude': payload['altitude'],
+        'signal_strength': payload['signal_strength'],
+        'timestamp': datetime.strptime(payload['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ"),
+        'date_created': datetime.utcnow(),
+        'trace_id': payload['trace_id'],
+        'geohash': geohash.encode(payload['latitude'], payload['longitude'])
+    }
+
+def target_acquisition_row(payload):
+
+    return {
+        'drone_id': payload['drone_id'],
+        'target_id': payload['target_id'],
+        'acquisition_type': payload['acquisition_type'],
+        'target_type': payload['target_type'],
+        'latitude': payload['latitude'],
+        'longitude': payload['longitude'],
+        'altitude': payload['altitude'],
+        'certainty': payload['certainty'],
+        'timestamp': datetime.strptime(payload['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ"),
+        'date_created': datetime.utcnow(),
+        'trace_id': payload['trace_id'],
+        'geohash': geohash.encode(payload['latitude'], payload['longitude'])
+    }
+
+def store_drone_positions(session, rows):
+
+    return store_events(session, DronePositionEvent, DronePositionRollup, rows)
+
+def store_target_acquisitions(session, rows):
+
+    return store_events(session, TargetAcquisitionEvent, TargetAcquisitionRollup, rows)
+
+def store_events(session, model, rollup, rows):
+    """
+    Inserts the rows that are not stored yet and returns how many were skipped as
+    duplicates. Replayed events are recognised by trace_id, both within the batch and
+    against the table, so they are neither inserted nor counted again in the rollups.
+    """
+    if not rows:
+        return 0
+
+    unique_rows = {}
+    for row in rows:
+        unique_rows.setdefault(row['trace_id'], row)
+
+    existing = session.execute(
+        select(model.trace_id).where(model.trace_id.in_(list(unique_rows)))
+    ).scalars().all()
+    for trace_id in existing:
+        del unique_rows[trace_id]
+
+    new_rows = list(unique_rows.values())
+    if new_rows:
+        # Stamped as they are written rather than when decoded, so a batch held back by
+        # retries still lands in the stats window that is read after it commits
+        date_created = datetime.utcnow()
+        for row in new_rows:
+            row['date_created'] = date_created
+        # The no-op update turns a duplicate that slipped in concurrently into a skip
+        statement = mysql_insert(model)
+        session.execute(statement.on_duplicate_key_update(id=model.__table__.c.id), new_rows)
+        update_rollups(session, rollup, ROLLUP_FIELDS[rollup], new_rows)
+
+    return len(rows) - len(new_rows)
+
+def update_rollups(session, rollup, fields, rows):
+    """
+    Folds event rows into per-minute, per-drone rollups inside the batch's transaction.
+    The batch is pre-aggregated here, so each touched bucket costs one upsert row.
+    """
+    buckets = {}
+
+    for row in rows:
+        key = (row['timestamp'].replace(second=0, microsecond=0), row['drone_id'])
+        bucket = buckets.get(key)
+
+        if bucket is None:
+            bucket = {'bucket_start': key[0], 'drone_id': key[1], 'count': 0}
+            for field in fields:
+                bucket[f'min_{field}'] = row[field]
+                bucket[f'max_{field}'] = row[field]
+                bucket[f'sum_{field}'] = 0
+            buckets[key] = bucket
+
+        bucket['count'] += 1
+        for field in fields:
+            value = row[field]
+            bucket[f'min_{field}'] = min(bucket[f'min_{field}'], value)
+            bucket[f'max_{field}'] = max(bucket[f'max_{field}'], value)
+            bucket[f'sum_{field}'] += value
+
+    # A stable key order keeps concurrent upserts from deadlocking on each other
+    values = [buckets[key] for key in sorted(buckets)]
+
+    statement = mysql_insert(rollup).values(values)
+    table = rollup.__table__
+    updates = {'count': table.c.count + statement.inserted.count}
+    for field in fields:
+        updates[f'min_{field}'] = func.least(table.c[f'min_{field}'], statement.inserted[f'min_{field}'])
+        updates[f'max_{field}'] = func.greatest(table.c[f'max_{field}'], statement.inserted[f'max_{field}'])
+        updates[f'sum_{field}'] = table.c[f'sum_{field}'] + statement.inserted[f'sum_{field}']
+
+    session.execute(statement.on_duplicate_key_update(updates))
+
+def store_batch(batch):
+    """
+    Writes a batch with one bulk insert per event type inside a single transaction.
+    Connection errors are retried until the database is back, also when they happen
+    while a batch that failed for any other reason is being written row by row so only
+    the offending rows are dropped.
+    """
+    delay = BATCH_RETRY_DELAY
+
+    while True:
+        try:
+            with DB_SESSION.begin() as session:
+                duplicates = store_drone_positions(session, batch.positions)
+                duplicates += store_target_acquisitions(session, batch.acquisitions)
+            break
+        except OperationalError as e:
+            logger.error(f"Database unavailable, retrying batch of {len(batch)} events in {delay}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, BATCH_MAX_RETRY_DELAY)
+        except SQLAlchemyError as e:
+            logger.error(f"Batch of {len(batch)} events failed, storing events one at a time: {e}")
+            try:
+                store_rows_individually(batch)
+                return
+            except OperationalError as e:
+                # Rows stored before the database went away are skipped as duplicates next time
+                logger.error(f"Database unavailable, retrying batch of {len(batch)} events in {delay}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, BATCH_MAX_RETRY_DELAY)
+
+    logger.debug(f"Stored batch of {len(batch.positions)} drone_position and "
+                 f"{len(batch.acquisitions)} target_acquisition events")
+    if duplicates:
+        logger.info(f"Skipped {duplicates} duplicate events in a batch of {len(batch)}")
+
+def store_rows_individually(batch):
+    """
+    Writes a batch one row per transaction, dropping the rows the database rejects.
+    Connection errors are raised, since they say nothing about the row.
+    """
+    duplicates = 0
+    for store, rows in ((store_drone_positions, batch.positions), (store_target_acquisitions, batch.acquisitions)):
+        for row in rows:
+            try:
+                with DB_SESSION.begin() as session:
+                    duplicates += store(session, [row])
+            except OperationalError:
+                raise
+            except SQLAlchemyError as e:
+                logger.error(f"Dropping event with trace id {row['trace_id']}: {e}")
+
+    if duplicates:
+        logger.info(f"Skipped {duplicates} duplicate events in a batch of {len(batch)}")
+
+def parse_timestamp(value):
+    # Event timestamps are stored as naive datetimes, ignore the 'Z' clients send
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+def encode_cursor(timestamp, event_id):
+
+    raw = f"{timestamp.isoformat()}|{event_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    timestamp, event_id = raw.split('|')
+    return datetime.fromisoformat(timestamp), int(event_id)
+
+def get_events_page(model, start_dt, end_dt, drone_id=None, limit=None, after=None, bbox=None):
+    """
+    Returns one page of events ordered by (timestamp, id) plus the cursor for the next
+    page, or None on the last page. The keyset condition lets the composite index seek
+    straight to the page, so every page costs the same however wide the window is.
+    Archived events are merged in from the cold segments that overlap the window.
+    bbox is an optional (min_lat, max_lat, min_lon, max_lon) box: the geohash index narrows
+    the scan to the cells covering it and the exact coordinates refine the candidates.
+    """
+    limit = min(limit or PAGE_DEFAULT_LIMIT, PAGE_MAX_LIMIT)
+    after_key = decode_cursor(after) if after is not None else None
+
+    statement = select(model).where(
+        model.timestamp >= start_dt,
+        model.timestamp < end_dt
+    )
 
-            elif msg["type"] == "target_acquisition":
+    if drone_id is not None:
+        statement = statement.where(model.drone_id == drone_id)
 
-                logger.info(f"Processing target acquisition event with trace_id: {payload['trace_id']}")
-                store_target_acquisition(payload)
-            consumer.commit_offsets()
+    if bbox is not None:
+        min_lat, max_lat, min_lon, max_lon = bbox
+        cells = geohash.cover(min_lat, max_lat, min_lon, max_lon, GEOHASH_MAX_CELLS)
+        statement = statement.where(
+            or_(*[model.geohash.like(f"{cell}%") for cell in cells]),
+            model.latitude.between(min_lat, max_lat),
+            model.longitude.between(min_lon, max_lon)
+        )
 
-        except Exception as e:
-            logger.error(f"Error processing message: {e}")
+    if after_key is not None:
+        after_dt, after_id = after_key
+        statement = statement.where(or_(
+            model.timestamp > after_dt,
+            and_(model.timestamp == after_dt, model.id > after_id)
+        ))
 
-def store_drone_position(payload):
+    statement = statement.order_by(model.timestamp, model.id).limit(limit + 1)
 
     session = DB_SESSION()
-    timestamp = datetime.strptime(payload['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ")
-
-    position = DronePositionEvent(
-        drone_id=payload['drone_id'],
-        latitude=payload['latitude'],
-        longitude=payload['longitude'],
-        altitude=payload['altitude'],
-        signal_strength=payload['signal_strength'],
-        timestamp=timestamp,
-        trace_id=payload['trace_id']
-    )
-
-    session.add(position)
-    session.commit()
+    events = [(event.timestamp, event.id, event.to_dict()) for event in session.execute(statement).scalars().all()]
     session.close()
 
-    logger.debug(f"Stored event drone_position with a trace id of {payload['trace_id']}")
+    if ARCHIVE_ENABLED:
+        cold_rows = archive.find_rows(ARCHIVE_DIRECTORY, model.__tablename__, start_dt, end_dt,
+                                      limit + 1, drone_id, after_key, bbox)
+        if cold_rows:
+            events.extend((row['timestamp'], row['id'], archive.row_to_dict(row)) for row in cold_rows)
+            events.sort(key=lambda event: (event[0], event[1]))
 
-def store_target_acquisition(payload):
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(events[-1][0], events[-1][1])
 
-    session = DB_SESSION()
-    timestamp = datetime.strptime(payload['timestamp'], "%Y-%m-%dT%H:%M:%S.%fZ")
-
-    acquisition = TargetAcquisitionEvent(
-        drone_id=payload['drone_id'],
-        target_id=payload['target_id'],
-        acquisition_type=payload['acquisition_type'],
-        target_type=payload['target_type'],
-        latitude=payload['latitude'],
-        longitude=payload['longitude'],
-        altitude=payload['altitude'],
-        certainty=payload['certainty'],
-        timestamp=timestamp,
-        trace_id=payload['trace_id']
+    results = [event for _, _, event in events]
+
+    logger.debug(f"Start Timestamp: {start_dt}, End Timestamp: {end_dt}")
+    return results, next_cursor
+
+def page_response(results, next_cursor):
+
+    if next_cursor is None:
+        return results, 200
+    return results, 200, {"X-Next-Cursor": next_cursor}
+
+def get_drone_positions(start_timestamp, end_timestamp, drone_id=None, limit=None, after=None):
+    try:
+        start_dt = parse_timestamp(start_timestamp)
+        end_dt = parse_timestamp(end_timestamp)
+    except ValueError:
+        logger.error(f"Invalid timestamp in drone position events request: {start_timestamp}, {end_timestamp}")
+        return {"message": "Invalid timestamp"}, 400
+
+    try:
+        results, next_cursor = get_events_page(DronePositionEvent, start_dt, end_dt, drone_id, limit, after)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        logger.error(f"Invalid cursor for drone position events: {after}")
+        return {"message": "Invalid cursor"}, 400
+
+    logger.info("Found %d drone position events (start: %s, end: %s)", len(results), start_timestamp, end_timestamp)
+
+    return page_response(results, next_cursor)
+
+def get_target_acquisitions(start_timestamp, end_timestamp, drone_id=None, limit=None, after=None):
+    try:
+        start_dt = parse_timestamp(start_timestamp)
+        end_dt = parse_timestamp(end_timestamp)
+    except ValueError:
+        logger.error(f"Invalid timestamp in target acquisition events request: {start_timestamp}, {end_timestamp}")
+        return {"message": "Invalid timestamp"}, 400
+
+    try:
+        results, next_cursor = get_events_page(TargetAcquisitionEvent, start_dt, end_dt, drone_id, limit, after)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        logger.error(f"Invalid cursor for target acquisition events: {after}")
+        return {"message": "Invalid cursor"}, 400
+
+    logger.info("Found %d target acquisition events (start: %s, end: %s)", len(results), start_timestamp, end_timestamp)
+
+    return page_response(results, next_cursor)
+
+def get_aggregates(rollup, fields, start_timestamp, end_timestamp, bucket_minutes=1, drone_id=None, per_drone=False):
+    """
+    Reads count, min, max and sum per bucket from the rollup tables. Buckets are
+    bucket_minutes wide and aligned to the epoch; the window is resolved to whole minutes.
+    """
+    start_dt = parse_timestamp(start_timestamp)
+    end_dt = parse_timestamp(end_timestamp)
+    bucket_seconds = bucket_minutes * 60
+
+    bucket = func.floor(func.unix_timestamp(rollup.bucket_start) / bucket_seconds) * bucket_seconds
+    columns = [func.from_unixtime(bucket).label('bucket_start')]
+    group_by = [bucket]
+
+    if per_drone:
+        columns.append(rollup.drone_id)
+        group_by.append(rollup.drone_id)
+
+    columns.append(func.sum(rollup.count).label('count'))
+    for field in fields:
+        columns.append(func.min(getattr(rollup, f'min_{field}')).label(f'min_{field}'))
+        columns.append(func.max(getattr(rollup, f'max_{field}')).label(f'max_{field}'))
+        columns.append(func.sum(getattr(rollup, f'sum_{field}')).label(f'sum_{field}'))
+
+    statement = select(*columns).where(
+        rollup.bucket_start >= start_dt.replace(second=0, microsecond=0),
+        rollup.bucket_start < end_dt
     )
 
-    session.add(acquisition)
-    session.commit()
-    session.close()
+    if drone_id is not None:
+        statement = statement.where(rollup.drone_id == drone_id)
 
-    logger.debug(f"Stored event target_acquisition with a trace id of {payload['trace_id']}")
+    statement = statement.group_by(*group_by).order_by(*group_by)
 
-def get_drone_positions(start_timestamp, end_timestamp):
-    start_dt = datetime.fromisoformat(start_timestamp)
-    end_dt = datetime.fromisoformat(end_timestamp)
+    with DB_ENGINE.connect() as connection:
+        results = []
+        for row in connection.execute(statement):
+            result = row._asdict()
+            result['bucket_start'] = result['bucket_start'].strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            result['count'] = int(result['count'])
+            results.append(result)
 
-    session = DB_SESSION()
+    logger.info("Found %d %s buckets (start: %s, end: %s)", len(results), rollup.__tablename__, start_dt, end_dt)
+    return results, 200
 
-    statement = select(DronePositionEvent).where(
-        DronePositionEvent.timestamp >= start_dt,
-        DronePositionEvent.timestamp < end_dt
+def get_events_in_area(model, start_timestamp, end_timestamp, min_latitude, max_latitude, min_longitude, max_longitude,
+                       drone_id=None, limit=None, after=None):
+
+    if min_latitude > max_latitude or min_longitude > max_longitude:
+        return {"message": "Bounding box minimums must not exceed its maximums"}, 400
+
+    bbox = (min_latitude, max_latitude, min_longitude, max_longitude)
+    try:
+        start_dt = parse_timestamp(start_timestamp)
+        end_dt = parse_timestamp(end_timestamp)
+    except ValueError:
+        logger.error(f"Invalid timestamp in {model.__tablename__} request: {start_timestamp}, {end_timestamp}")
+        return {"message": "Invalid timestamp"}, 400
+
+    try:
+        results, next_cursor = get_events_page(model, start_dt, end_dt, drone_id, limit, after, bbox)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        logger.error(f"Invalid cursor for {model.__tablename__}: {after}")
+        return {"message": "Invalid cursor"}, 400
+
+    logger.info("Found %d %s in area %s (start: %s, end: %s)", len(results), model.__tablename__, bbox, start_timestamp, end_timestamp)
+
+    return page_response(results, next_cursor)
+
+def get_drone_positions_in_area(start_timestamp, end_timestamp, min_latitude, max_latitude, min_longitude, max_longitude,
+                                drone_id=None, limit=None, after=None):
+
+    return get_events_in_area(DronePositionEvent, start_timestamp, end_timestamp, min_latitude, max_latitude,
+                              min_longitude, max_longitude, drone_id, limit, after)
+
+def get_target_acquisitions_in_area(start_timestamp, end_timestamp, min_latitude, max_latitude, min_longitude, max_longitude,
+                                    drone_id=None, limit=None, after=None):
+
+    return get_events_in_area(TargetAcquisitionEvent, start_timestamp, end_timestamp, min_latitude, max_latitude,
+                              min_longitude, max_longitude, drone_id, limit, after)
+
+def get_event_stats(start_timestamp, end_timestamp):
+    """
+    Returns the count and maximum of each event type stored in [start, end), computed in
+    SQL so the response stays four numbers however many events the window holds. The
+    window is on date_created, not the event timestamp: a buffered upload recorded
+    before the previous window still counts once, in the window it arrived in.
+    """
+    start_dt = parse_timestamp(start_timestamp)
+    end_dt = parse_timestamp(end_timestamp)
+    stats = {}
+
+    with DB_ENGINE.connect() as connection:
+        for model, value_column, count_key, max_key in STATS_COLUMNS:
+            count, maximum = connection.execute(
+                select(func.count(), func.max(value_column)).where(
+                    model.date_created >= start_dt,
+                    model.date_created < end_dt
+                )
+            ).one()
+            stats[count_key] = count
+            stats[max_key] = maximum
+
+    logger.info(f"Event stats {stats} (start: {start_dt}, end: {end_dt})")
+    return stats, 200
+
+def get_event_summaries(start_timestamp, end_timestamp):
+    """
+    Returns what processing's sketches need from the events stored in [start, end): how
+    often each signal strength and certainty value occurs, and each drone's count and
+    maximum per event type. Both are grouped in SQL, so the response grows with the
+    distinct values and active drones, never with the number of events.
+    """
+    start_dt = parse_timestamp(start_timestamp)
+    end_dt = parse_timestamp(end_timestamp)
+    summaries = {}
+    drones = {}
+
+    with DB_ENGINE.connect() as connection:
+        for model, value_column, count_key, max_key in STATS_COLUMNS:
+            window = (model.date_created >= start_dt, model.date_created < end_dt)
+            rows = connection.execute(
+                select(value_column, func.count()).where(*window).group_by(value_column)
+            ).all()
+            summaries[value_column.key] = [[value, count] for value, count in rows]
+
+            rows = connection.execute(
+                select(model.drone_id, func.count(), func.max(value_column)).where(*window).group_by(model.drone_id)
+            ).all()
+            for drone_id, count, maximum in rows:
+                drone = drones.setdefault(drone_id, {
+                    'drone_id': drone_id,
+                    'num_drone_positions': 0,
+                    'max_signal_strength': None,
+                    'num_target_acquisitions': 0,
+                    'max_certainty': None
+                })
+                drone[count_key] = count
+                drone[max_key] = maximum
+
+    summaries['drones'] = list(drones.values())
+    logger.info(f"Event summaries of {len(drones)} drones (start: {start_dt}, end: {end_dt})")
+    return summaries, 200
+
+def get_drone_position_aggregates(start_timestamp, end_timestamp, bucket_minutes=1, drone_id=None, per_drone=False):
+
+    return get_aggregates(DronePositionRollup, ROLLUP_FIELDS[DronePositionRollup], start_timestamp, end_timestamp,
+                          bucket_minutes, drone_id, per_drone)
+
+def get_target_acquisition_aggregates(start_timestamp, end_timestamp, bucket_minutes=1, drone_id=None, per_drone=False):
+
+    return get_aggregates(TargetAcquisitionRollup, ROLLUP_FIELDS[TargetAcquisitionRollup], start_timestamp, end_timestamp,
+                          bucket_minutes, drone_id, per_drone)
+
+def event_row_to_json(row):
+
+    event = row._asdict()
+    event['timestamp'] = event['timestamp'].isoformat(timespec='microseconds') + 'Z'
+    event['date_created'] = event['date_created'].isoformat(timespec='microseconds') + 'Z'
+    return json.dumps(event)
+
+def stream_events(model, start_timestamp, end_timestamp, drone_id=None):
+    """
+    Streams every event in the window as NDJSON. Rows come from a Core select on a
+    server-side cursor and are written out chunk by chunk, so memory stays flat and the
+    first bytes go out before the query has finished. Archived events are merged in
+    (timestamp, id) order, one day of segments at a time.
+    """
+    start_dt = parse_timestamp(start_timestamp)
+    end_dt = parse_timestamp(end_timestamp)
+
+    statement = select(*model.__table__.columns).where(
+        model.timestamp >= start_dt,
+        model.timestamp < end_dt
     )
 
-    results = [result.to_dict() for result in session.execute(statement).scalars().all()]
+    if drone_id is not None:
+        statement = statement.where(model.drone_id == drone_id)
 
-    logger.info("Found %d drone position events (start: %s, end: %s)", len(results), start_dt, end_dt)
+    statement = statement.order_by(model.timestamp, model.id)
 
-    session.close()
-    return results, 200
+    def generate():
+        count = 0
+        with DB_ENGINE.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=STREAM_CHUNK_SIZE).execute(statement)
+            events = ((row.timestamp, row.id, event_row_to_json(row)) for row in result)
+            if ARCHIVE_ENABLED:
+                cold_rows = archive.iter_rows(ARCHIVE_DIRECTORY, model.__tablename__, start_dt, end_dt, drone_id)
+                cold_events = ((row['timestamp'], row['id'], json.dumps(archive.row_to_dict(row))) for row in cold_rows)
+                events = heapq.merge(cold_events, events, key=lambda event: event[:2])
 
-def get_target_acquisitions(start_timestamp, end_timestamp):
-    start_dt = datetime.fromisoformat(start_timestamp)
-    end_dt = datetime.fromisoformat(end_timestamp)
+            chunk = []
+            last_key = None
+            for event in events:
+                # A row being archived right now can be in a segment and in MySQL at once
+                if event[:2] == last_key:
+                    continue
+                last_key = event[:2]
+                chunk.append(event[2] + '\n')
+                if len(chunk) >= STREAM_CHUNK_SIZE:
+                    count += len(chunk)
+                    yield ''.join(chunk)
+                    chunk = []
+            if chunk:
+                count += len(chunk)
+                yield ''.join(chunk)
 
-    session = DB_SESSION()
+        logger.info("Streamed %d %s events (start: %s, end: %s)", count, model.__tablename__, start_dt, end_dt)
 
-    statement = select(TargetAcquisitionEvent).where(
-        TargetAcquisitionEvent.timestamp >= start_dt,
-        TargetAcquisitionEvent.timestamp < end_dt
-    )
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
-    results = [result.to_dict() for result in session.execute(statement).scalars().all()]
-    logger.debug(f"Start Timestamp: {start_dt}, End Timestamp: {end_dt}")
+def stream_drone_positions(start_timestamp, end_timestamp, drone_id=None):
 
-    logger.info("Found %d target acquisition events (start: %s, end: %s)", len(results), start_dt, end_dt)
+    return stream_events(DronePositionEvent, start_timestamp, end_timestamp, drone_id)
 
-    session.close()
-    return results, 200
+def stream_target_acquisitions(start_timestamp, end_timestamp, drone_id=None):
+
+    return stream_events(TargetAcquisitionEvent, start_timestamp, end_timestamp, drone_id)
+
+def archive_events(model):
+    """
+    Moves events older than archive.max_age_days out of MySQL into day segments. Rows
+    are deleted by id only after their segment is safely on disk, and a chunk that is
+    archived twice after a crash rewrites the same part file.
+    """
+    cutoff = datetime.now() - timedelta(days=app_config['archive']['max_age_days'])
+    columns = [column.name for column in model.__table__.columns]
+    archived = 0
+
+    while True:
+        statement = select(*model.__table__.columns).where(
+            model.timestamp < cutoff
+        ).order_by(model.timestamp, model.id).limit(ARCHIVE_CHUNK_SIZE)
+
+        with DB_ENGINE.connect() as connection:
+            rows = connection.execute(statement).mappings().all()
+
+        if not rows:
+            break
+
+        days = {}
+        for row in rows:
+            days.setdefault(row['timestamp'].date(), []).append(row)
+
+        for day, day_rows in days.items():
+            filename = archive.write_segment(ARCHIVE_DIRECTORY, model.__tablename__, day, day_rows, columns)
+
+            ids = [row['id'] for row in day_rows]
+            with DB_SESSION.begin() as session:
+                for i in range(0, len(ids), 1000):
+                    session.execute(delete(model).where(model.id.in_(ids[i:i + 1000])))
+
+            logger.debug(f"Archived {len(day_rows)} {model.__tablename__} rows to {filename}")
+
+        archived += len(rows)
+
+    if archived:
+        logger.info(f"Archived {archived} {model.__tablename__} rows older than {cutoff}")
+
+def run_retention():
+
+    while True:
+        for model in (DronePositionEvent, TargetAcquisitionEvent):
+            try:
+                archive_events(model)
+            except Exception as e:
+                logger.error(f"Error archiving {model.__tablename__}: {e}")
+
+        time.sleep(app_config['archive']['interval_hours'] * 3600)
+
+def setup_retention_thread():
+
+    logger.info("Setting up retention thread")
+    t1 = Thread(target=run_retention, daemon=True)
+    t1.start()
 
 def setup_kafka_thread():
 
@@ -188,4 +808,6 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
 
 if __name__ == "__main__":
     setup_kafka_thread()
+    if ARCHIVE_ENABLED:
+        setup_retention_thread()
     app.run(port=8090, host="0.0.0.0")
@@ -0,0 +1,229 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Cold events live in compressed columnar segment files:
+#
+#   <directory>/<table>/<YYYY-MM-DD>/part-<first id>.npz
+#
+# Every segment holds one numpy array per column. Timestamps are stored as int64
+# microseconds and strings as fixed width unicode, so segments load without
+# pickle. Segments are grouped by the day of the event timestamp, which lets a
+# range query skip every day outside its window by looking at directory names.
+
+DAY_FORMAT = "%Y-%m-%d"
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+EPOCH = datetime(1970, 1, 1)
+DATETIME_COLUMNS = ('timestamp', 'date_created')
+# Stored as '' when NULL, since string columns are fixed width unicode
+NULLABLE_COLUMNS = ('geohash',)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 16
+
+
+def to_micros(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+def day_directory(directory, table, day):
+    return os.path.join(directory, table, day.strftime(DAY_FORMAT))
+
+
+def write_segment(directory, table, day, rows, columns):
+    """
+    Writes the rows of one day as a segment. The file is written under a temporary
+    name and renamed into place, so readers never see a partial segment.
+    """
+    path = day_directory(directory, table, day)
+    os.makedirs(path, exist_ok=True)
+
+    arrays = {}
+    for column in columns:
+        values = [row[column] for row in rows]
+        if column in DATETIME_COLUMNS:
+            arrays[column] = np.array([to_micros(value) for value in values], dtype=np.int64)
+        elif any(isinstance(value, str) for value in values) or all(value is None for value in values):
+            # Strings are stored fixed width, rows written before a column existed get ''
+            arrays[column] = np.array(['' if value is None else value for value in values], dtype=str)
+        else:
+            arrays[column] = np.array(values)
+
+    filename = os.path.join(path, f"part-{rows[0]['id']}.npz")
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    return filename
+
+
+def load_segment(filename):
+
+    with _cache_lock:
+        if filename in _cache:
+            _cache.move_to_end(filename)
+            return _cache[filename]
+
+    with np.load(filename, allow_pickle=False) as data:
+        segment = {column: data[column] for column in data.files}
+
+    with _cache_lock:
+        _cache[filename] = segment
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return segment
+
+
+def segment_files(directory, table, start_dt, end_dt):
+    """
+    Yields (day, filenames) for the days that overlap [start_dt, end_dt), oldest first.
+    """
+    table_directory = os.path.join(directory, table)
+    if not os.path.isdir(table_directory):
+        return
+
+    first_day = start_dt.date()
+    for name in sorted(os.listdir(table_directory)):
+        try:
+            day = datetime.strptime(name, DAY_FORMAT).date()
+        except ValueError:
+            continue
+        if day < first_day or datetime.combine(day, datetime.min.time()) >= end_dt:
+            continue
+
+        path = os.path.join(table_directory, name)
+        filenames = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.npz'))
+        if filenames:
+            yield day, filenames
+
+
+def segment_row(segment, index):
+
+    row = {column: values[index].item() for column, values in segment.items()}
+    for column in DATETIME_COLUMNS:
+        row[column] = from_micros(row[column])
+    return row
+
+
+def find_rows(directory, table, start_dt, end_dt, limit=None, drone_id=None, after=None, bbox=None):
+    """
+    Returns archived rows in [start_dt, end_dt) ordered by (timestamp, id), stopping once
+    limit rows are found. after is an exclusive (timestamp, id) keyset position and bbox an
+    optional (min_lat, max_lat, min_lon, max_lon) box.
+    Filtering and ordering run on the column arrays; only returned rows become dicts.
+    """
+    start_micros = to_micros(start_dt)
+    end_micros = to_micros(end_dt)
+    results = []
+
+    for day, filenames in segment_files(directory, table, start_dt, end_dt):
+        segments = []
+        matches = []
+
+        for filename in filenames:
+            segment = load_segment(filename)
+            timestamps = segment['timestamp']
+
+            mask = (timestamps >= start_micros) & (timestamps < end_micros)
+            if drone_id is not None:
+                mask &= segment['drone_id'] == drone_id
+            if after is not None:
+                after_micros, after_id = to_micros(after[0]), after[1]
+                mask &= (timestamps > after_micros) | ((timestamps == after_micros) & (segment['id'] > after_id))
+            if bbox is not None:
+                min_lat, max_lat, min_lon, max_lon = bbox
+                mask &= (segment['latitude'] >= min_lat) & (segment['latitude'] <= max_lat)
+                mask &= (segment['longitude'] >= min_lon) & (segment['longitude'] <= max_lon)
+
+            indexes = np.flatnonzero(mask)
+            if len(indexes):
+                segments.append(segment)
+                matches.append(indexes)
+
+        if not matches:
+            continue
+
+        # Order the day's matches across all of its segments by (timestamp, id)
+        owners = np.concatenate([np.full(len(indexes), i) for i, indexes in enumerate(matches)])
+        indexes = np.concatenate(matches)
+        timestamps = np.concatenate([segment['timestamp'][m] for segment, m in zip(segments, matches)])
+        ids = np.concatenate([segment['id'][m] for segment, m in zip(segments, matches)])
+        order = np.lexsort((ids, timestamps))
+
+        if limit is not None:
+            order = order[:limit - len(results)]
+
+        results.extend(segment_row(segments[owners[i]], indexes[i]) for i in order)
+
+        # Days are visited in order, so a full page ends the scan
+        if limit is not None and len(results) >= limit:
+            break
+
+    return results
+
+
+def iter_rows(directory, table, start_dt, end_dt, drone_id=None):
+    """
+    Yields the archived rows in [start_dt, end_dt) ordered by (timestamp, id), holding
+    only one day's matches in memory at a time.
+    """
+    for day, _ in segment_files(directory, table, start_dt, end_dt):
+        day_start = datetime.combine(day, datetime.min.time())
+        yield from find_rows(directory, table, max(start_dt, day_start), min(end_dt, day_start + timedelta(days=1)),
+                             drone_id=drone_id)
+
+
+def row_to_dict(row):
+
+    event = dict(row)
+    for column in DATETIME_COLUMNS:
+        event[column] = event[column].strftime(TIMESTAMP_FORMAT)
+    for column in NULLABLE_COLUMNS:
+        if event.get(column) == '':
+            event[column] = None
+    return event
+
+
+def day_rollups(directory, table, fields):
+    """
+    Yields (day, buckets) with the per-minute, per-drone rollup rows of every archived
+    day, oldest first. A day's segments are aggregated together with numpy; minutes
+    never cross days, so only one day is held in memory at a time.
+    """
+    for day, filenames in segment_files(directory, table, datetime.min, datetime.max):
+        segments = [load_segment(filename) for filename in filenames]
+        minutes = np.concatenate([segment['timestamp'] for segment in segments]) // 60000000
+        drone_ids = np.concatenate([segment['drone_id'] for segment in segments])
+
+        keys, inverse = np.unique(np.rec.fromarrays([minutes, drone_ids]), return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+        counts = np.diff(np.r_[starts, len(order)])
+
+        columns = {}
+        for field in fields:
+            values = np.concatenate([segment[field] for segment in segments]).astype(float)[order]
+            columns[f'min_{field}'] = np.minimum.reduceat(values, starts)
+            columns[f'max_{field}'] = np.maximum.reduceat(values, starts)
+            columns[f'sum_{field}'] = np.add.reduceat(values, starts)
+
+        buckets = []
+        for i, (minute, drone_id) in enumerate(keys.tolist()):
+            bucket = {'bucket_start': from_micros(minute * 60000000), 'drone_id': drone_id, 'count': int(counts[i])}
+            for name, values in columns.items():
+                bucket[name] = float(values[i])
+            buckets.append(bucket)
+        yield day, buckets
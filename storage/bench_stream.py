@@ -0,0 +1,103 @@
+"""
+Compares the list-building response path (ORM objects + to_dict + one JSON
+document) with the streaming NDJSON path (Core rows on a streamed result).
+Runs against an in-memory SQLite database so it needs no MySQL server.
+
+    python3 bench_stream.py [num_rows]
+"""
+import json
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from Lab3_models import Base, DronePositionEvent
+
+CHUNK_SIZE = 1000
+
+
+def event_row_to_json(row):
+
+    event = row._asdict()
+    event['timestamp'] = event['timestamp'].isoformat(timespec='microseconds') + 'Z'
+    event['date_created'] = event['date_created'].isoformat(timespec='microseconds') + 'Z'
+    return json.dumps(event)
+
+
+def populate(engine, num_rows):
+    start = datetime(2025, 1, 7, 10, 0, 0)
+    rows = [{
+        'drone_id': f"drone{random.randrange(1000)}",
+        'latitude': random.uniform(-90, 90),
+        'longitude': random.uniform(-180, 180),
+        'altitude': random.uniform(0, 1000),
+        'signal_strength': random.randrange(100),
+        'timestamp': start + timedelta(milliseconds=i),
+        'date_created': start + timedelta(milliseconds=i),
+        'trace_id': str(uuid.uuid4())
+    } for i in range(num_rows)]
+
+    with engine.begin() as connection:
+        connection.execute(insert(DronePositionEvent), rows)
+
+
+def list_path(session_factory):
+    session = session_factory()
+    statement = select(DronePositionEvent)
+    results = [result.to_dict() for result in session.execute(statement).scalars().all()]
+    body = json.dumps(results)
+    session.close()
+    yield body
+
+
+def stream_path(engine):
+    statement = select(*DronePositionEvent.__table__.columns).order_by(DronePositionEvent.timestamp, DronePositionEvent.id)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=CHUNK_SIZE).execute(statement)
+        for rows in result.partitions():
+            yield ''.join([event_row_to_json(row) + '\n' for row in rows])
+
+
+def consume(chunks):
+    start = time.perf_counter()
+    first_byte = None
+    total_bytes = 0
+
+    for chunk in chunks:
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        total_bytes += len(chunk)
+
+    return time.perf_counter() - start, first_byte, total_bytes
+
+
+def bench(name, make_chunks, num_rows):
+    elapsed, first_byte, total_bytes = consume(make_chunks())
+
+    # Memory is measured on a second run, tracemalloc slows everything down
+    tracemalloc.start()
+    consume(make_chunks())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:>6}: {num_rows / elapsed:9.0f} rows/s  first byte {first_byte * 1000:8.1f} ms  "
+          f"peak memory {peak / 2 ** 20:7.1f} MiB  ({total_bytes / 2 ** 20:.1f} MiB sent)")
+
+
+if __name__ == "__main__":
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random.seed(42)
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    populate(engine, num_rows)
+
+    print(f"{num_rows} drone position rows")
+    session_factory = sessionmaker(bind=engine)
+    bench("list", lambda: list_path(session_factory), num_rows)
+    bench("stream", lambda: stream_path(engine), num_rows)
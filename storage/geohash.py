@@ -0,0 +1,79 @@
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+PRECISION = 9
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """
+    Returns the geohash of a point. Neighbouring points share long prefixes, so an
+    index on the geohash column serves a cell as one range scan.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                value = (value << 1) | 1
+                lon_range[0] = mid
+            else:
+                value <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                value = (value << 1) | 1
+                lat_range[0] = mid
+            else:
+                value <<= 1
+                lat_range[1] = mid
+
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """
+    Returns (height, width) in degrees of a cell at the given precision.
+    """
+    total_bits = 5 * precision
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def cover(min_lat, max_lat, min_lon, max_lon, max_cells=32):
+    """
+    Returns the geohash prefixes of the cells covering a bounding box, at the finest
+    precision that needs no more than max_cells cells.
+    """
+    best = [""]
+
+    for precision in range(1, PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = int(max_lat // height) - int(min_lat // height) + 1
+        cols = int(max_lon // width) - int(min_lon // width) + 1
+        if rows * cols > max_cells:
+            break
+
+        cells = set()
+        lat = (min_lat // height) * height
+        while lat <= max_lat:
+            lon = (min_lon // width) * width
+            while lon <= max_lon:
+                cells.add(encode(min(lat + height / 2, 90.0), min(lon + width / 2, 180.0), precision))
+                lon += width
+            lat += height
+        best = sorted(cells)
+
+    return best
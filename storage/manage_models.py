@@ -1,6 +1,9 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, insert, update, delete, func, text, inspect, bindparam
 from sqlalchemy.orm import sessionmaker
-from Lab3_models import Base
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from Lab3_models import Base, DronePositionEvent, TargetAcquisitionEvent, DronePositionRollup, TargetAcquisitionRollup
+import geohash
+import archive
 import yaml
 import logging
 import logging.config
@@ -36,6 +39,93 @@ def create_tables():
     logger.info("Tables created successfully.")
     print("Tables created successfully.")
 
+def migrate_tables():
+    # create_all skips tables that already exist, so add any missing indexes explicitly
+    Base.metadata.create_all(engine)
+    add_missing_columns()
+    backfill_geohashes()
+    remove_duplicate_events()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    logger.info("Tables migrated successfully.")
+    print("Tables migrated successfully.")
+
+def add_missing_columns():
+    # Columns added to the models after a table was created, all of them nullable
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type} NULL"))
+                    logger.info(f"Added column {column.name} to {table.name}")
+
+def backfill_geohashes():
+    for model in (DronePositionEvent, TargetAcquisitionEvent):
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(
+                    select(model.id, model.latitude, model.longitude).where(model.geohash.is_(None)).limit(10000)
+                ).all()
+                if not rows:
+                    break
+                connection.execute(
+                    update(model).where(model.id == bindparam('row_id')).values(geohash=bindparam('row_geohash')),
+                    [{'row_id': row.id, 'row_geohash': geohash.encode(row.latitude, row.longitude)} for row in rows]
+                )
+            logger.info(f"Backfilled geohash for {len(rows)} {model.__tablename__} rows")
+
+def remove_duplicate_events():
+    # The trace_id unique indexes cannot be created while replayed events are still stored
+    with engine.begin() as connection:
+        for table in (DronePositionEvent.__tablename__, TargetAcquisitionEvent.__tablename__):
+            result = connection.execute(text(
+                f"DELETE newer FROM {table} newer JOIN {table} older "
+                f"ON newer.trace_id = older.trace_id AND newer.id > older.id"
+            ))
+            if result.rowcount:
+                logger.info(f"Removed {result.rowcount} duplicate events from {table}, run 'rollup' to recount.")
+                print(f"Removed {result.rowcount} duplicate events from {table}, run 'rollup' to recount.")
+
+def rebuild_rollups():
+    # Storage keeps the rollups up to date while ingesting, this backfills existing events.
+    # Archived days are no longer in MySQL, they are counted from their segments
+    rollups = (
+        (DronePositionRollup, DronePositionEvent, ('signal_strength', 'altitude')),
+        (TargetAcquisitionRollup, TargetAcquisitionEvent, ('certainty', 'altitude'))
+    )
+    with engine.begin() as connection:
+        for rollup, event, fields in rollups:
+            bucket = func.date_format(event.timestamp, '%Y-%m-%d %H:%i:00')
+            names = ['bucket_start', 'drone_id', 'count']
+            columns = [bucket, event.drone_id, func.count()]
+            for field in fields:
+                names += [f'min_{field}', f'max_{field}', f'sum_{field}']
+                column = getattr(event, field)
+                columns += [func.min(column), func.max(column), func.sum(column)]
+
+            connection.execute(delete(rollup))
+            connection.execute(insert(rollup).from_select(names, select(*columns).group_by(bucket, event.drone_id)))
+
+            # The minute the archive cutoff fell in can hold both hot and archived
+            # events, so archived buckets are merged into what is already there
+            for day, buckets in archive.day_rollups(app_config['archive']['directory'], event.__tablename__, fields):
+                for i in range(0, len(buckets), 1000):
+                    statement = mysql_insert(rollup).values(buckets[i:i + 1000])
+                    table = rollup.__table__
+                    updates = {'count': table.c.count + statement.inserted.count}
+                    for field in fields:
+                        updates[f'min_{field}'] = func.least(table.c[f'min_{field}'], statement.inserted[f'min_{field}'])
+                        updates[f'max_{field}'] = func.greatest(table.c[f'max_{field}'], statement.inserted[f'max_{field}'])
+                        updates[f'sum_{field}'] = table.c[f'sum_{field}'] + statement.inserted[f'sum_{field}']
+                    connection.execute(statement.on_duplicate_key_update(updates))
+                logger.info(f"Rebuilt {len(buckets)} {rollup.__tablename__} buckets from the {day} archive")
+    logger.info("Rollups rebuilt successfully.")
+    print("Rollups rebuilt successfully.")
+
 def drop_tables():
     Base.metadata.drop_all(engine)
     logger.info("Tables dropped successfully.")
@@ -43,9 +133,13 @@ def drop_tables():
 
 if __name__ == "__main__":
     while True:
-        action = input("Choose an action: [create/drop/exit]: ").strip().lower()
+        action = input("Choose an action: [create/migrate/rollup/drop/exit]: ").strip().lower()
         if action == "create":
             create_tables()
+        elif action == "migrate":
+            migrate_tables()
+        elif action == "rollup":
+            rebuild_rollups()
         elif action == "drop":
             drop_tables()
         elif action == "exit":
@@ -53,4 +147,4 @@ if __name__ == "__main__":
             print("Exiting the script.")
             break
         else:
-            print("Invalid option. Please choose 'create', 'drop', or 'exit'.")
+            print("Invalid option. Please choose 'create', 'migrate', 'rollup', 'drop', or 'exit'.")